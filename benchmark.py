@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import resource
+import selectors
+import subprocess
+import tempfile
+from collections import deque
+
+from protocol import MESSAGE, FrameDecoder, encode_frame, hello
+
+
+# Every timed message carries this marker followed by its send time in nanoseconds
+MARK = 'bench'
+
+# What a benchmarked client may do
+TRAFFIC = ('chat', 'whisper', 'list', 'switch')
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatserver.py')
+
+
+class BenchClient:
+    # One synthetic chat client, driven by the benchmark's selector loop
+
+    __slots__ = ('name', 'channel', 'socket', 'decoder', 'outgoing', 'state', 'expect')
+
+    def __init__(self, name, channel):
+        self.name = name
+        self.channel = channel
+        self.socket = None
+        self.decoder = FrameDecoder()
+        self.outgoing = bytearray()
+        self.state = 'connecting'   # connecting -> waiting -> active -> closed
+        # What each '[ Channel ]' reply answers, oldest first: ('admission', t) for the
+        # probe sent on connecting, ('switch', t) after a /switch, ('list', t) for a /list
+        self.expect = deque()
+
+
+def percentiles(samples):
+    # Milliseconds, from samples in nanoseconds
+    if not samples:
+        return {'count': 0}
+    samples.sort()
+    n = len(samples)
+    pick = lambda q: round(samples[min(n - 1, int(q * n))] / 1e6, 3)
+    return {'count': n, 'p50': pick(0.50), 'p99': pick(0.99), 'p999': pick(0.999),
+            'max': round(samples[-1] / 1e6, 3)}
+
+
+def process_tree(pid):
+    # The server and every process it forked (sharded mode)
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, ()))
+    return tree
+
+
+def server_usage(pid):
+    # (resident set in KiB, CPU seconds) summed over the server's processes
+    rss, cpu = 0, 0.0
+    ticks = os.sysconf('SC_CLK_TCK')
+    for proc in process_tree(pid):
+        try:
+            with open(f'/proc/{proc}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+            with open(f'/proc/{proc}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss, cpu
+
+
+def free_ports(count):
+    # The config format only takes ports below 1024
+    ports = []
+    for port in range(600, 1024):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            probe.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        finally:
+            probe.close()
+        ports.append(port)
+        if len(ports) == count:
+            return ports
+    print("Not enough free ports below 1024 (binding them needs root).", file=sys.stderr)
+    sys.exit(1)
+
+
+class Harness:
+    # What the benchmark and soak.py share: a chatserver.py started on a generated config,
+    # one channel per name, and framed writes to synthetic clients from one selector.
+    # Subclasses start the server and define close(client).
+
+    def __init__(self, args, channels):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.channels = channels
+        self.ports = {}
+        self.config = None
+        self.server = None
+        self.mix = []
+        total = sum(args.mix.values())
+        acc = 0.0
+        for kind, weight in args.mix.items():
+            acc += weight / total
+            self.mix.append((acc, kind))
+
+    def write_config(self, prefix, capacity, flush_interval=None):
+        ports = free_ports(len(self.channels))
+        self.config = tempfile.NamedTemporaryFile('w', prefix=prefix, suffix='.cfg', delete=False)
+        for channel, port in zip(self.channels, ports):
+            self.ports[channel] = port
+            if flush_interval is None:
+                self.config.write(f"channel {channel} {port} {capacity}\n")
+            else:
+                self.config.write(f"channel {channel} {port} {capacity} {flush_interval:g}\n")
+        self.config.close()
+
+    def launch(self, options=()):
+        # Runs the server on the config and waits until every channel port answers
+        command = [sys.executable, SERVER, self.config.name, '--mode', self.args.mode,
+                   '--workers', str(self.args.workers)] + list(options) + self.args.server_args
+        log = open(self.args.server_log, 'w') if self.args.server_log else subprocess.DEVNULL
+        self.server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + 10
+        for port in self.ports.values():
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if self.server.poll() is not None or time.monotonic() > deadline:
+                        print("The server did not start.", file=sys.stderr)
+                        sys.exit(1)
+                    time.sleep(0.05)
+
+    def stop_server(self):
+        try:
+            self.admin('/shutdown')
+            self.server.wait(timeout=3)
+        except (OSError, subprocess.TimeoutExpired):
+            self.server.kill()
+            self.server.wait()
+        os.unlink(self.config.name)
+
+    def admin(self, command):
+        self.server.stdin.write(command.encode('utf-8') + b'\n')
+        self.server.stdin.flush()
+
+    def send(self, client, msg):
+        was_empty = not client.outgoing
+        client.outgoing += encode_frame(msg.encode('utf-8'))
+        if was_empty:
+            self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.socket.send(client.outgoing)
+            del client.outgoing[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close(client)
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if client.outgoing else selectors.EVENT_READ
+        if self.selector.get_key(client.socket).events != events:
+            self.selector.modify(client.socket, events, client)
+
+
+class Benchmark(Harness):
+
+    def __init__(self, args):
+        super().__init__(args, [f'bench{i}' for i in range(args.channels)])
+        self.clients = []
+        self.members = {channel: [] for channel in self.channels}   # active clients, for whisper targets
+        self.samples = {'fanout': [], 'whisper': [], 'list': [], 'admission': [], 'switch': []}
+        self.sent = dict.fromkeys(TRAFFIC, 0)
+        self.delivered = 0
+        self.disconnected = 0
+
+    def start_server(self):
+        self.write_config('bench-', self.args.capacity or -(-self.args.clients // len(self.channels)),
+                          self.args.flush_interval)
+        self.launch()
+        # Let the probe connections be cleaned up before measuring
+        time.sleep(0.2)
+
+    # Client I/O
+
+    def connect(self, client):
+        client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.socket.setblocking(False)
+        client.socket.connect_ex(("127.0.0.1", self.ports[client.channel]))
+        # The /list probe is held by the server until the client is admitted
+        client.expect.append(('admission', time.monotonic_ns()))
+        client.outgoing += hello(client.name) + encode_frame(b'/list')
+        self.selector.register(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        client.state = 'waiting'
+
+    def close(self, client):
+        if client.state == 'closed':
+            return
+        if client.state == 'active':
+            self.members[client.channel].remove(client)
+        client.state = 'closed'
+        self.disconnected += 1
+        self.selector.unregister(client.socket)
+        client.socket.close()
+
+    def read(self, client):
+        try:
+            data = client.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close(client)
+            return
+        now = time.monotonic_ns()
+        for kind, payload in client.decoder.feed(data):
+            if kind == MESSAGE:
+                self.on_message(client, payload.decode('utf-8', 'replace'), now)
+
+    def on_message(self, client, msg, now):
+        marker = msg.rfind(f'] {MARK} ')
+        if marker != -1:
+            sample = now - int(msg[marker + len(MARK) + 3:])
+            self.samples['whisper' if ' whispers to you:' in msg else 'fanout'].append(sample)
+            self.delivered += 1
+        elif msg.startswith('[ Channel ]') and client.expect:
+            what, started = client.expect.popleft()
+            if what == 'list':
+                self.samples['list'].append(now - started)
+            else:
+                self.samples[what].append(now - started)
+                client.state = 'active'
+                self.members[client.channel].append(client)
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            if events & selectors.EVENT_WRITE:
+                self.flush(client)
+            if events & selectors.EVENT_READ and client.state != 'closed':
+                self.read(client)
+
+    # Traffic
+
+    def act(self, client):
+        pick = random.random()
+        kind = next(kind for acc, kind in self.mix if pick <= acc)
+        stamp = f"{MARK} {time.monotonic_ns()}"
+        if kind == 'chat':
+            self.send(client, stamp)
+        elif kind == 'whisper':
+            target = random.choice(self.members[client.channel])
+            self.send(client, f"/whisper {target.name} {stamp}")
+        elif kind == 'list':
+            client.expect.append(('list', time.monotonic_ns()))
+            self.send(client, '/list')
+        elif kind == 'switch':
+            others = [channel for channel in self.channels if channel != client.channel]
+            if not others:
+                return
+            self.members[client.channel].remove(client)
+            client.channel = random.choice(others)
+            client.state = 'waiting'
+            client.expect.append(('switch', time.monotonic_ns()))
+            self.send(client, f"/switch {client.channel}")
+            self.send(client, '/list')
+        self.sent[kind] += 1
+
+    def run(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        self.start_server()
+        try:
+            return self.measure()
+        finally:
+            self.stop_server()
+
+    def measure(self):
+        args = self.args
+        rss_idle, _ = server_usage(self.server.pid)
+
+        # Connect at a steady rate, the listen backlog is small
+        self.clients = [BenchClient(f'b{i}', self.channels[i % len(self.channels)]) for i in range(args.clients)]
+        started = time.monotonic()
+        connected = 0
+        deadline = started + args.connect_timeout
+        while time.monotonic() < deadline:
+            due = min(args.clients, int((time.monotonic() - started) * args.connect_rate) + 1)
+            while connected < due:
+                self.connect(self.clients[connected])
+                connected += 1
+            if connected == args.clients and all(c.state != 'waiting' for c in self.clients):
+                break
+            self.poll(0.005)
+        connect_seconds = time.monotonic() - started
+        admitted = sum(1 for c in self.clients if c.state == 'active')
+        time.sleep(0.2)
+        rss_loaded, cpu_before = server_usage(self.server.pid)
+
+        # Drive the traffic mix at the requested rate over the admitted clients
+        issued = 0
+        started = time.monotonic()
+        while time.monotonic() - started < args.duration:
+            due = int((time.monotonic() - started) * args.rate)
+            if issued < due:
+                active = [c for c in self.clients if c.state == 'active']
+                while issued < due and active:
+                    client = random.choice(active)
+                    if client.state == 'active':
+                        self.act(client)
+                    issued += 1
+            self.poll(0.001)
+        traffic_seconds = time.monotonic() - started
+        _, cpu_after = server_usage(self.server.pid)
+
+        # Let whatever is in flight arrive
+        drain_until = time.monotonic() + args.drain
+        while time.monotonic() < drain_until:
+            self.poll(0.01)
+
+        return {
+            'config': {
+                'clients': args.clients, 'channels': args.channels, 'capacity': args.capacity,
+                'mode': args.mode, 'workers': args.workers, 'rate': args.rate,
+                'duration': args.duration, 'mix': args.mix, 'server_args': args.server_args,
+                'cpus': os.cpu_count(), 'python': sys.version.split()[0],
+            },
+            'connect': {'clients': args.clients, 'admitted': admitted, 'seconds': round(connect_seconds, 3)},
+            'throughput': {
+                'actions_per_s': round(sum(self.sent.values()) / traffic_seconds, 1),
+                'delivered_per_s': round(self.delivered / traffic_seconds, 1),
+                'sent': self.sent,
+                'delivered': self.delivered,
+                'server_cpu_s': round(cpu_after - cpu_before, 3),
+            },
+            'fanout_latency_ms': percentiles(self.samples['fanout']),
+            'whisper_latency_ms': percentiles(self.samples['whisper']),
+            'list_latency_ms': percentiles(self.samples['list']),
+            'admission_delay_ms': percentiles(self.samples['admission']),
+            'switch_admission_ms': percentiles(self.samples['switch']),
+            'memory': {
+                'server_rss_idle_kib': rss_idle,
+                'server_rss_loaded_kib': rss_loaded,
+                'per_connection_bytes': round((rss_loaded - rss_idle) * 1024 / max(args.clients, 1)),
+            },
+            'disconnected': self.disconnected,
+        }
+
+
+# Metrics compared against a baseline run: (path, True when higher is better)
+COMPARED = [
+    (('throughput', 'delivered_per_s'), True),
+    (('fanout_latency_ms', 'p99'), False),
+    (('whisper_latency_ms', 'p99'), False),
+    (('list_latency_ms', 'p99'), False),
+    (('admission_delay_ms', 'p99'), False),
+    (('memory', 'per_connection_bytes'), False),
+]
+
+
+def compare(results, baseline, tolerance):
+    # Returns a line for every metric that got worse than the baseline by more than tolerance
+    regressions = []
+    for path, higher_is_better in COMPARED:
+        new, old = results, baseline
+        for key in path:
+            new, old = new.get(key, {}), old.get(key, {})
+        if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{'.'.join(path)}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def parse_mix(text, kinds=TRAFFIC, what='traffic kind'):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in kinds:
+            raise argparse.ArgumentTypeError(f"unknown {what} {kind!r}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test chatserver.py on a generated config and report JSON results.")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--capacity', type=int, default=0, help="per channel, default fits every client")
+    parser.add_argument('--flush-interval', type=float, help="milliseconds, batched delivery on every channel")
+    parser.add_argument('--mode', choices=['threaded', 'eventloop'], default='eventloop')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=2000, help="actions per second across all clients")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=0.85,whisper=0.05,list=0.05,switch=0.05'))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--connect-rate', type=float, default=500, help="new connections per second")
+    parser.add_argument('--connect-timeout', type=float, default=60)
+    parser.add_argument('--drain', type=float, default=1)
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--compare', help="baseline JSON results, exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    parser.add_argument('--server-log')
+    parser.add_argument('server_args', nargs='*', help="extra chatserver.py options, after --")
+    args = parser.parse_args()
+
+    results = Benchmark(args).run()
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
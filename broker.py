@@ -0,0 +1,401 @@
+import os
+import sys
+import pickle
+import selectors
+import itertools
+from collections import OrderedDict
+from datetime import datetime
+
+from protocol import FrameDecoder, encode_frame
+from outbound import DISCONNECT, OutboundQueue
+from metrics import merge_snapshots, open_scrape_socket, render_prometheus, render_stats
+from ratelimit import describe_limits, parse_limits
+
+
+# Broker links carry whole chat messages plus pickling overhead
+MAX_LINK_FRAME = 4 * 1024 * 1024
+# Backlog a link may build up before the other end is considered stuck
+LINK_LIMIT = 64 * 1024 * 1024
+
+
+class Link:
+    # One end of the unix socket between the broker and a worker, or of a relay link
+    # between federated nodes. Messages are pickled tuples ('kind', args...) in the same
+    # length-prefixed frames the clients use.
+
+    def __init__(self, sock, selector, data, loads=pickle.loads):
+        sock.setblocking(False)
+        self.socket = sock
+        self.selector = selector
+        self.data = data
+        self.loads = loads
+        self.decoder = FrameDecoder(MAX_LINK_FRAME)
+        self.outbox = OutboundQueue(LINK_LIMIT, DISCONNECT)
+        self.events = selectors.EVENT_READ
+        selector.register(sock, self.events, data)
+
+    def send(self, *msg):
+        was_idle = self.outbox.idle()
+        if not self.outbox.push(encode_frame(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))):
+            raise ConnectionError("broker link is not draining")
+        if was_idle:
+            self.flush()
+
+    def flush(self):
+        drained = self.outbox.write(self.socket)
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.selector.modify(self.socket, events, self.data)
+
+    def receive(self):
+        # Every message now complete, or None once the other end has gone
+        try:
+            data = self.socket.recv(1024 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            return None
+        return [self.loads(payload) for kind, payload in self.decoder.feed(data)]
+
+    def close(self):
+        self.selector.unregister(self.socket)
+        self.socket.close()
+
+
+class ChannelDirectory:
+    # The authoritative view of a set of channels: who is a member, who is queued, and
+    # which shard serves them. Makes every admission decision and routes whispers and
+    # broadcasts between shards. Subclasses deliver the outcome with send() and send_all().
+
+    def __init__(self, channels):
+        self.channels = {}
+        for channel_name, channel_info in channels.items():
+            self.channels[channel_name] = {
+                'capacity': channel_info['capacity'],
+                'clients': {},              # username -> (shard, ref)
+                'queue': OrderedDict(),     # username -> [shard, ref, last position told]
+                'waiting': 0,               # queue length the shards were last told
+                'limits': channel_info['limits'],   # every shard enforces them on its own clients
+            }
+
+    def locate(self, channel_name, username):
+        # The shard serving this member or queued client, or None
+        channel_info = self.channels[channel_name]
+        entry = channel_info['clients'].get(username) or channel_info['queue'].get(username)
+        return entry[0] if entry else None
+
+    # Channel membership, the same rules ChatServer applies within a single process
+
+    def admit(self, channel_name, notify_from=None):
+        channel_info = self.channels[channel_name]
+        queue = channel_info['queue']
+        admitted = []
+        while queue and len(channel_info['clients']) < channel_info['capacity']:
+            username, (shard, ref, position) = queue.popitem(last=False)
+            channel_info['clients'][username] = (shard, ref)
+            admitted.append((shard, ref))
+            self.send_all('member', channel_name, username, shard)
+
+        # Counts go out first, so whatever the admitted clients do sees them updated
+        if channel_info['waiting'] != len(queue):
+            channel_info['waiting'] = len(queue)
+            self.send_all('waiting', channel_name, len(queue))
+        for shard, ref in admitted:
+            self.send(shard, 'admit', ref)
+
+        if admitted:
+            self.notify_queue_positions(channel_name)
+        elif notify_from is not None:
+            self.notify_queue_positions(channel_name, notify_from)
+
+    def notify_queue_positions(self, channel_name, start=0):
+        queue = self.channels[channel_name]['queue']
+        for queue_position, entry in enumerate(itertools.islice(queue.values(), start, None), start):
+            if entry[2] == queue_position:
+                continue
+            entry[2] = queue_position
+            self.send(entry[0], 'position', entry[1], queue_position)
+
+    def remove(self, channel_name, username, shard, ref):
+        # Returns True if the client was a member, False if it was queued or not found
+        channel_info = self.channels[channel_name]
+        if channel_info['clients'].get(username) == (shard, ref):
+            del channel_info['clients'][username]
+            self.send_all('member', channel_name, username, None)
+            return True
+        entry = channel_info['queue'].get(username)
+        if entry is not None and entry[:2] == [shard, ref]:
+            del channel_info['queue'][username]
+            self.notify_queue_positions(channel_name, entry[2] or 0)
+        return False
+
+    def on_join(self, shard, channel_name, username, ref):
+        channel_info = self.channels[channel_name]
+        if username in channel_info['clients'] or username in channel_info['queue']:
+            self.send(shard, 'rejected', ref)
+            return
+        channel_info['queue'][username] = [shard, ref, None]
+        self.send(shard, 'queued', ref)
+        self.admit(channel_name, len(channel_info['queue']) - 1)
+
+    def on_leave(self, shard, channel_name, username, ref):
+        self.remove(channel_name, username, shard, ref)
+        self.admit(channel_name)
+
+    def on_switch(self, shard, channel_name, new_channel_name, username, ref):
+        new_channel_info = self.channels[new_channel_name]
+        if username in new_channel_info['clients'] or username in new_channel_info['queue']:
+            self.send(shard, 'switch_refused', ref, new_channel_name)
+            return
+        if channel_name in self.channels:
+            was_member = self.remove(channel_name, username, shard, ref)
+        else:
+            # Federation: the old channel is homed on another node, the client's node
+            # leaves it there once it is told None
+            was_member = None
+        new_channel_info['queue'][username] = [shard, ref, None]
+        self.send(shard, 'switched', ref, new_channel_name, was_member)
+        if channel_name in self.channels:
+            self.admit(channel_name)
+        self.admit(new_channel_name, len(new_channel_info['queue']) - 1)
+
+    # Traffic between shards
+
+    def on_broadcast(self, shard, channel_name, data, history=False):
+        self.send_all('deliver', channel_name, data, history, skip=shard)
+
+    def on_tell(self, shard, channel_name, username, data):
+        target = self.locate(channel_name, username)
+        if target is not None:
+            self.send(target, 'tell', channel_name, username, data)
+
+    def on_send(self, shard, channel_name, username, target_username, file_path, upload_path):
+        entry = self.channels[channel_name]['clients'].get(target_username)
+        if entry is None:
+            error_msg = f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] {target_username} is not here."
+            self.send(shard, 'tell', channel_name, username, error_msg.encode('utf-8'))
+            return
+        self.send(entry[0], 'send', channel_name, username, target_username, file_path, upload_path)
+
+    def forget(self, shard):
+        # The shard is gone, and everyone it served with it
+        for channel_name, channel_info in self.channels.items():
+            for username, entry in list(channel_info['clients'].items()):
+                if entry[0] == shard:
+                    self.remove(channel_name, username, *entry)
+            for username, entry in list(channel_info['queue'].items()):
+                if entry[0] == shard:
+                    self.remove(channel_name, username, entry[0], entry[1])
+            self.admit(channel_name)
+
+
+class ShardBroker(ChannelDirectory):
+    # Runs in the parent process when the server is started with --workers N. It owns
+    # the server-wide view of every channel (who is a member, who is queued, and on
+    # which worker), makes every admission decision, relays broadcasts and whispers
+    # between workers, and runs the admin console.
+
+    def __init__(self, channels, metrics_socket=None):
+        super().__init__(channels)
+        self.workers = []   # (shard, socket, pid) until run() starts
+        self.links = {}     # shard -> Link
+        self.selector = None
+        self.command_buffer = b''
+        self.metrics_socket = metrics_socket
+        self.stats_requests = {}    # request id -> [shards yet to answer, merged snapshot, callback]
+        self.request_ids = itertools.count(1)
+
+    def add_worker(self, shard, sock, pid):
+        self.workers.append((shard, sock, pid))
+
+    def detach(self):
+        # Called in a freshly forked worker, which must not hold the other workers' links
+        for shard, sock, pid in self.workers:
+            sock.close()
+
+    def run(self):
+        # The selector is created after the fork, an epoll set would be shared otherwise
+        self.selector = selectors.DefaultSelector()
+        for shard, sock, pid in self.workers:
+            self.links[shard] = Link(sock, self.selector, (self.handle_link, shard))
+        try:
+            self.selector.register(sys.stdin, selectors.EVENT_READ, (self.read_server_commands, None))
+        except (PermissionError, ValueError):
+            pass
+        if self.metrics_socket is not None:
+            listener = open_scrape_socket(self.metrics_socket)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, (self.accept_scrape, None))
+
+        while self.links:
+            for key, events in self.selector.select():
+                callback, data = key.data
+                try:
+                    callback(key.fileobj, data, events)
+                except SystemExit:
+                    raise
+                except Exception as e:
+                    print(f"Error in broker: {e}")
+        sys.exit(1)
+
+    def handle_link(self, sock, shard, events):
+        link = self.links[shard]
+        if events & selectors.EVENT_WRITE:
+            link.flush()
+        if not events & selectors.EVENT_READ:
+            return
+        messages = link.receive()
+        if messages is None:
+            print(f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] Worker {shard} exited.")
+            self.drop_shard(shard)
+            return
+        for kind, *args in messages:
+            getattr(self, 'on_' + kind)(shard, *args)
+
+    def send(self, shard, *msg):
+        link = self.links.get(shard)
+        if link is not None:
+            link.send(*msg)
+
+    def send_all(self, *msg, skip=None):
+        for shard, link in self.links.items():
+            if shard != skip:
+                link.send(*msg)
+
+    def drop_shard(self, shard):
+        # A worker died, everyone it served is gone
+        self.links.pop(shard).close()
+        for request_id in list(self.stats_requests):
+            self.on_stats(shard, request_id, None)
+        self.forget(shard)
+
+    # Metrics, every worker keeps its own and the broker merges them on request
+
+    def gauges(self):
+        return {channel_name: (len(channel_info['clients']), channel_info['capacity'], len(channel_info['queue']))
+                for channel_name, channel_info in self.channels.items()}
+
+    def collect_stats(self, callback):
+        # callback(snapshot, gauges) runs once every worker has answered
+        request_id = next(self.request_ids)
+        snapshot = {'counters': {}, 'histograms': {}, 'uptime': 0.0}
+        self.stats_requests[request_id] = [set(self.links), snapshot, callback]
+        self.send_all('stats', request_id)
+
+    def on_stats(self, shard, request_id, snapshot):
+        request = self.stats_requests.get(request_id)
+        if request is None:
+            return
+        request[0].discard(shard)
+        if snapshot is not None:
+            merge_snapshots(request[1], snapshot)
+        if not request[0]:
+            del self.stats_requests[request_id]
+            request[2](request[1], self.gauges())
+
+    def accept_scrape(self, listener, _, events):
+        try:
+            conn, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.collect_stats(lambda snapshot, gauges: self.answer_scrape(conn, render_prometheus(snapshot, gauges)))
+
+    def answer_scrape(self, conn, text):
+        try:
+            conn.setblocking(True)
+            conn.sendall(text.encode('utf-8'))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    # Admin console. Commands are checked here against the server-wide state and
+    # carried out by the shard that serves the user.
+
+    def read_server_commands(self, stdin, _, events):
+        data = os.read(stdin.fileno(), 4096)
+        if not data:
+            self.selector.unregister(stdin)
+            return
+        self.command_buffer += data
+        while b'\n' in self.command_buffer:
+            line, self.command_buffer = self.command_buffer.split(b'\n', 1)
+            self.process_server_command(line.decode('utf-8', 'replace').strip())
+
+    def process_server_command(self, command):
+        current_time = datetime.now().strftime("%H:%M:%S")
+        if command == "/shutdown":
+            self.shutdown()
+
+        if command in ("/reload", "/upgrade"):
+            print(f"[Server message ({current_time}) ] {command} is not available with --workers, restart the server instead.")
+
+        if command == "/stats":
+            self.collect_stats(lambda snapshot, gauges: print('\n'.join(render_stats(snapshot, gauges))))
+
+        if command.startswith("/mute"):
+            try:
+                _, channel_user, mute_time = command.split(" ", 2)
+                channel_name, username = channel_user.split(":", 1)
+                if int(mute_time) <= 0:
+                    raise ValueError("Invalid mute time.")
+            except ValueError as e:
+                print(f"[Server message ({current_time}) ] {e}")
+                return
+            if channel_name not in self.channels:
+                print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
+            elif self.locate(channel_name, username) is None:
+                print(f"[Server message ({current_time})] {username} is not here.")
+            else:
+                self.send(self.locate(channel_name, username), 'command', command)
+
+        if command.startswith('/empty'):
+            channel_name = command[len('/empty'):].strip()
+            if channel_name not in self.channels:
+                print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
+                return
+            self.send_all('empty', channel_name)
+            print(f"[Server message ({current_time}) ] {channel_name} has been emptied.")
+
+        if command.startswith('/limit '):
+            channel_name, *rates = command.split()[1:]
+            if channel_name != '*' and channel_name not in self.channels:
+                print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
+                return
+            names = list(self.channels) if channel_name == '*' else [channel_name]
+            if not rates:
+                for name in names:
+                    print(f"[Server message ({current_time}) ] Limits for {name}: {describe_limits(self.channels[name]['limits'])}.")
+                return
+            try:
+                limits = parse_limits(rates)
+            except ValueError:
+                print(f"[Server message ({current_time}) ] Invalid limit: {' '.join(rates)}")
+                return
+            for name in names:
+                self.channels[name]['limits'] = limits
+                self.send_all('limit', name, limits)
+            print(f"[Server message ({current_time}) ] Limits for {channel_name}: {describe_limits(limits)}.")
+
+        if command.split(' ', 1)[0] in ('/profile', '/memory', '/stacks', '/timing'):
+            # Every worker profiles itself and writes files named after its pid
+            self.send_all('command', command)
+
+        if command.startswith('/kick '):
+            channel_name, _, username = command[len('/kick '):].partition(':')
+            if channel_name not in self.channels:
+                print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
+            elif username in self.channels[channel_name]['clients']:
+                self.send(self.channels[channel_name]['clients'][username][0], 'command', command)
+            else:
+                print(f"[Server message ({current_time}) ] {username} is not in {channel_name}.")
+
+    def shutdown(self):
+        self.send_all('shutdown')
+        for shard, sock, pid in self.workers:
+            os.waitpid(pid, 0)
+        print("[Server message] The server is shutting down.")
+        sys.exit(0)
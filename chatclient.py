@@ -1,24 +1,147 @@
+import os
 import sys
-import socket
-import threading
+import argparse
+import itertools
 
-def receive_msgs(client_socket):
-    while True:
+from protocol import FILE_CHUNK, FILE_END, FILE_HEADER, FILE_START, FILE_START_HEADER
+from clientlib import ClientLoop, ClientSession
+
+# Bytes of stdin read per wakeup, a piped transcript arrives in large pieces
+STDIN_READ = 256 * 1024
+
+# Stdin is not read while a session has this many bytes waiting to be written, so a
+# transcript faster than the server never piles up in memory
+HIGH_WATER = 1024 * 1024
+
+def save_path(name):
+    # Received files go to the working directory and never overwrite an existing file
+    base, ext = os.path.splitext(os.path.basename(name) or 'file')
+    path, n = base + ext, 1
+    while os.path.exists(path):
+        path = f"{base} ({n}){ext}"
+        n += 1
+    return path
+
+def receive_file_frame(kind, payload, files, output):
+    transfer_id, = FILE_HEADER.unpack_from(payload)
+    if kind == FILE_START:
+        transfer_id, size = FILE_START_HEADER.unpack_from(payload)
+        path = save_path(payload[FILE_START_HEADER.size:].decode('utf-8', 'replace'))
+        files[transfer_id] = (open(path, 'wb'), path, size)
+        output(f"[ Receiving {path} ({size} bytes) ]")
+    elif kind == FILE_CHUNK:
+        if transfer_id in files:
+            files[transfer_id][0].write(memoryview(payload)[FILE_HEADER.size:])
+    elif kind == FILE_END:
+        if transfer_id in files:
+            file, path, size = files.pop(transfer_id)
+            file.close()
+            output(f"[ Received {path} ({size} bytes) ]")
+
+class Output:
+    # Everything the client prints, written to stdout in one go after each poll. With
+    # several sessions every line starts with the username it was received by.
+
+    def __init__(self, prefixed=False, quiet=False):
+        self.buffer = []
+        self.prefixed = prefixed
+        self.quiet = quiet
+
+    def write(self, session, text):
+        if self.quiet:
+            return
+        self.buffer.append(f"{session.username}: {text}\n" if self.prefixed else text + '\n')
+
+    def flush(self):
+        if not self.buffer:
+            return
+        text, self.buffer = ''.join(self.buffer), []
         try:
-            msg = client_socket.recv(1024).decode('utf-8')
-            print(msg)
-        except:
-            print("An error occurred. Closing the connection.")
-            client_socket.close()
-            break
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # Whoever reads our output has gone, the sessions carry on
+            self.quiet = True
 
-def main():
-    if len(sys.argv) != 3:
-        print("Client properly started with following format: python3 chatclient.py <port> <username>")
+class StdinReader:
+    # Streams stdin to the sessions one message per line, handing lines out round robin.
+    # Reading pauses while any session is backed up. At the end of input every session quits.
+
+    def __init__(self, loop, sessions):
+        self.loop = loop
+        self.sessions = itertools.cycle(sessions)
+        self.partial = b''
+        self.reading = False
+        self.done = False
+        # A regular file or /dev/null cannot be waited on, it is read whenever the loop comes round
+        self.always_ready = False
+
+    def resume(self):
+        if self.reading or self.done:
+            return
+        self.reading = True
+        if self.always_ready:
+            return
+        try:
+            self.loop.watch(sys.stdin, self.read)
+        except PermissionError:
+            self.always_ready = True
+
+    def pause(self):
+        if self.reading and not self.always_ready:
+            self.loop.unwatch(sys.stdin)
+        self.reading = False
+
+    def ready(self):
+        # True when read() should be called without waiting for the loop
+        return self.reading and self.always_ready
+
+    def read(self):
+        data = os.read(sys.stdin.fileno(), STDIN_READ)
+        if not data:
+            self.pause()
+            self.done = True
+            lines = [self.partial]
+        else:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if line:
+                self.loop.send(next(self.sessions), line)
+        if self.done:
+            for session in self.loop.sessions:
+                self.loop.quit(session)
+
+    def throttle(self):
+        backlog = max(session.queued for session in self.loop.sessions)
+        if backlog > HIGH_WATER:
+            self.pause()
+        elif backlog < HIGH_WATER // 2:
+            self.resume()
+
+class ClientArgumentParser(argparse.ArgumentParser):
+
+    def error(self, message):
+        print("Client properly started with following format: python3 chatclient.py <port> <username> [channel] [--sessions N] [--reconnect] [--quiet]")
         sys.exit(1)
 
+def main():
+    parser = ClientArgumentParser(add_help=False)
+    parser.add_argument('port')
+    parser.add_argument('username')
+    # Only for a server's shared port, which serves every channel
+    parser.add_argument('channel', nargs='?')
+    # Connections opened by this one process, named <username>1 to <username>N
+    parser.add_argument('--sessions', type=int, default=1)
+    # Connect again with growing delays whenever the connection is lost
+    parser.add_argument('--reconnect', action='store_true')
+    # Do not print what is received, for load generation
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
     try:
-        port = int(sys.argv[1])
+        port = int(args.port)
     except ValueError:
         print("Invalid port number")
         sys.exit(1)
@@ -27,24 +150,42 @@ def main():
         print("Invalid port number")
         sys.exit(1)
 
-    username = sys.argv[2]
+    if args.sessions < 1:
+        parser.error("--sessions must be at least 1")
 
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    output = Output(prefixed=args.sessions > 1, quiet=args.quiet)
+    files = {}  # session -> transfer id -> (open file, path, size)
 
-    try:
-        client_socket.connect(("127.0.0.1", port))
-    except:
-        print("Failed to connect to the server.")
-        sys.exit(1)
+    def on_frame(session, kind, payload):
+        receive_file_frame(kind, payload, files.setdefault(session, {}), lambda text: output.write(session, text))
+
+    def on_close(session, reason):
+        if reason is not None and not session.quitting and session.ever_connected:
+            output.write(session, reason)
 
-    client_socket.send(username.encode('utf-8'))
+    loop = ClientLoop(on_message=output.write, on_frame=on_frame, on_close=on_close)
+    if args.sessions == 1:
+        names = [args.username]
+    else:
+        names = [f"{args.username}{i}" for i in range(1, args.sessions + 1)]
+    sessions = [loop.add(ClientSession(port, name, args.channel, reconnect=args.reconnect)) for name in names]
 
-    receive_thread = threading.Thread(target=receive_msgs, args=(client_socket,))
-    receive_thread.start()
+    stdin = StdinReader(loop, sessions)
+    stdin.resume()
+    try:
+        while loop.active():
+            loop.poll(0 if stdin.ready() else None)
+            if stdin.ready():
+                stdin.read()
+            output.flush()
+            stdin.throttle()
+    except KeyboardInterrupt:
+        pass
+    output.flush()
 
-    while True:
-        msg = input()
-        client_socket.send(msg.encode('utf-8'))
+    if not any(session.ever_connected for session in sessions):
+        print("Failed to connect to the server.")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,167 +1,646 @@
 
 import os
 import sys
+import math
+import signal
 import socket
+import select
+import argparse
+import selectors
 import threading
-from datetime import datetime, timedelta
+import itertools
+from collections import OrderedDict, deque
+from datetime import datetime
 import time
 
+from protocol import FramedCodec, Payload, ProtocolError, RawCodec, negotiate
+from outbound import DEFAULT_LIMIT, DROP_OLDEST, FLUSH_RESOLUTION, POLICIES, OutboundQueue, OutboundWriter
+from sessions import RemoteUser, Session, SessionRegistry
+from broker import Link, ShardBroker
+from federation import HOME_MESSAGES, NODE_MESSAGES, ChannelHome, Relay, read_nodes
+from metrics import Metrics, TimedLock, open_scrape_socket, render_prometheus, render_stats, serve_scrapes
+from logsink import DEFAULT_BACKUPS, DEFAULT_BUFFER, DEFAULT_MAX_BYTES, FORMATS, LogSink
+from history import DEFAULT_HISTORY_BYTES, DEFAULT_HISTORY_SIZE, DEFAULT_REPLAY_COUNT, History
+from timers import TimerWheel
+from profiling import COMMAND_METRIC, Profiler, command_name
+from ratelimit import DEFAULT_FLOOD_MUTE, DEFAULT_FLOOD_STRIKES, FLOOD_WINDOW, NO_LIMITS, RateLimit, TokenBucket, describe_limits, parse_limits
+from transfer import DEFAULT_MAX_FILE_SIZE, FileFrame, Transfer, format_size
+from handoff import TAKEOVER_TIMEOUT, receive_state, send_state, spawn_successor
+
+
+# Seconds a member may stay silent before being treated as AFK
+AFK_TIMEOUT = 100
+# Messages a queued client may send before being admitted, the rest are dropped and
+# the client is told so
+QUEUED_MESSAGE_LIMIT = 64
+# Seconds queue positions are held back after a departure, so a burst of departures
+# costs every queued client one update instead of one each
+QUEUE_NOTIFY_DELAY = 0.1
+# Connections the kernel holds for a listener until they are accepted, and how many
+# are accepted per wakeup before other work gets a turn
+DEFAULT_BACKLOG = 128
+DEFAULT_ACCEPT_BATCH = 64
+
+
+def read_config(config_file):
+    # Returns channel name -> (port, capacity, flush interval in seconds, rate limits).
+    # Raises ValueError with the message to show.
+    if not os.path.isfile(config_file):
+        raise ValueError(f"Configuration file '{config_file}' not found.")
+    #reading through config files
+    with open(config_file, 'r') as f:
+        lines = f.readlines()
+
+    channels = {}
+    ports = set()
+    limits = {}     # channel name, or * for every other channel -> rate limits
+    for line in lines:
+        parts = line.strip().split()
+
+        if len(parts) == 6 and parts[0].lower() == 'limit':
+            try:
+                limits[parts[1]] = parse_limits(parts[2:])
+            except ValueError:
+                raise ValueError(f"Invalid limit: {' '.join(parts[2:])}")
+            continue
 
-class ChatServer:
+        if parts and parts[0].lower() == 'node':
+            # Federation, read by read_nodes() in federation.py
+            continue
 
-    def __init__(self, config_file):
-        self.config_file = config_file
-        self.channels = {}
-        self.muted = {}
+        if len(parts) not in (4, 5) or parts[0].lower() != 'channel':
+            raise ValueError(f"Invalid configuration")
 
+        channel_name = parts[1]
+        if channel_name[0].isdigit():
+            raise ValueError(f"Channel name cannot begin with a number")
 
-    def load_channels(self):
-        if not os.path.isfile(self.config_file):
-            print(f"Configuration file '{self.config_file}' not found.")
-            sys.exit(1)
-        #reading through config files
-        with open(self.config_file, 'r') as f:
-            lines = f.readlines()
+        try:
+            channel_port = int(parts[2])
+        except ValueError:
+            raise ValueError(f"Invalid channel port: {parts[2]}")
+
+        if(channel_port>=1024 and channel_port<=65535):
+            raise ValueError("Ephemeral ports are invalid")
+        elif(channel_port>65535):
+            raise ValueError("invalid port Number Greater than 65535")
+        try:
+            channel_capacity = int(parts[3])
+            if channel_capacity < 5:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Invalid channel capacity: {parts[3]}")
+
+        # Optional: milliseconds output to the channel's members is held back and sent
+        # in one batch, 0 (the default) delivers every message right away
+        flush_interval = 0
+        if len(parts) == 5:
+            try:
+                flush_interval = float(parts[4])
+                if not 0 <= flush_interval <= 1000:
+                    raise ValueError
+            except ValueError:
+                raise ValueError(f"Invalid flush interval: {parts[4]}")
 
-        for line in lines:
-            parts = line.strip().split()
+        if channel_name in channels:
+            raise ValueError(f"Duplicate channel name: {channel_name}")
 
-            if len(parts) != 4 or parts[0].lower() != 'channel':
-                print(f"Invalid configuration")
-                sys.exit(1)
+        # Port 0: no listener of its own, the channel is reached through the shared port
+        if channel_port != 0:
+            if channel_port in ports:
+                raise ValueError(f"Duplicate channel port: {channel_port}")
+            ports.add(channel_port)
 
-            channel_name = parts[1]
-            if channel_name[0].isdigit():
-                print(f"Channel name cannot begin with a number")
-                sys.exit(1)
+        channels[channel_name] = (channel_port, channel_capacity, flush_interval / 1000)
 
-            try:
-                channel_port = int(parts[2])
-            except ValueError:
-                print(f"Invalid channel port: {parts[2]}")
-                sys.exit(1)
+    for channel_name in limits:
+        if channel_name != '*' and channel_name not in channels:
+            raise ValueError(f"Limit for unknown channel: {channel_name}")
+    default_limits = limits.get('*', NO_LIMITS)
+    return {channel_name: settings + (limits.get(channel_name, default_limits),)
+            for channel_name, settings in channels.items()}
 
-            if(channel_port>=1024 and channel_port<=65535):
-                print("Ephemeral ports are invalid")
-                sys.exit(1)
-            elif(channel_port>65535):
-                print("invalid port Number Greater than 65535")
-                sys.exit(1)
-            try:
-                channel_capacity = int(parts[3])
-                if channel_capacity < 5:
-                    raise ValueError
-            except ValueError:
-                print(f"Invalid channel capacity: {parts[3]}")
-                sys.exit(1)
 
-            if channel_name in self.channels:
-                print(f"Duplicate channel name: {channel_name}")
+class ChatServer:
+    # Set by engines whose processes share the channel ports
+    reuse_port = False
+    # Whether client and listening sockets are used in blocking mode
+    blocking_sockets = True
+
+    def __init__(self, config_file, outbox_limit=DEFAULT_LIMIT, overflow_policy=DROP_OLDEST,
+                 max_file_size=DEFAULT_MAX_FILE_SIZE, metrics_socket=None, history_size=DEFAULT_HISTORY_SIZE,
+                 history_bytes=DEFAULT_HISTORY_BYTES, replay_count=DEFAULT_REPLAY_COUNT, log_file=None,
+                 log_max_bytes=DEFAULT_MAX_BYTES, log_backups=DEFAULT_BACKUPS, log_fsync=None, log_format='text',
+                 log_buffer=DEFAULT_BUFFER, shared_port=None, backlog=DEFAULT_BACKLOG,
+                 accept_batch=DEFAULT_ACCEPT_BATCH, flood_strikes=DEFAULT_FLOOD_STRIKES,
+                 flood_mute=DEFAULT_FLOOD_MUTE, profile_dir='.', afk_timeout=AFK_TIMEOUT, upload_dir=None):
+        self.config_file = config_file
+        self.channels = {}
+        self.registry = SessionRegistry()
+        self.outbox_limit = outbox_limit
+        self.overflow_policy = overflow_policy
+        self.max_file_size = max_file_size
+        self.transfer_ids = itertools.count(1)
+        self.writer = None
+        self.metrics = Metrics()
+        self.metrics_socket = metrics_socket
+        self.timers = TimerWheel()
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.replay_count = replay_count
+        self.log_sink = LogSink(self.metrics, log_file, log_max_bytes, log_backups, log_fsync, log_format, log_buffer)
+        # One listener for every channel, clients name the channel in their handshake
+        self.shared_port = shared_port
+        self.shared_listener = None
+        self.backlog = backlog
+        self.accept_batch = accept_batch
+        # Rejections by a client's rate limit before it is muted (0 never), and for how long
+        self.flood_strikes = flood_strikes
+        self.flood_mute = flood_mute
+        self.afk_timeout = afk_timeout
+        # The only directory /send reads files from, None turns /send off
+        self.upload_dir = None if upload_dir is None else os.path.realpath(upload_dir)
+        # Started and stopped by the profiling admin commands, all off by default
+        self.profiler = Profiler(profile_dir)
+        self.command_timing = False
+        # Threaded mode: threads started by spawn() and how many of them are parked by pause()
+        self.pause_cond = threading.Condition()
+        self.pausing = False
+        self.running = 0
+        self.parked = 0
+        self.pause_wakeup = None
+        # Sessions taken over from the previous server process, resumed by start()
+        self.adopted = []
+        self.takeover_link = None
+        self.console_backlog = b''     # console input read but not run yet
+
+
+    def load_channels(self):
+        try:
+            config = read_config(self.config_file)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        for channel_name, (channel_port, channel_capacity, flush_interval, limits) in config.items():
+            if channel_port == self.shared_port:
+                print(f"Duplicate channel port: {channel_port}")
                 sys.exit(1)
+            self.add_channel(channel_name, channel_port, channel_capacity, flush_interval, limits)
+
+    def add_channel(self, channel_name, channel_port, channel_capacity, flush_interval=0, limits=NO_LIMITS):
+        self.channels[channel_name] = {
+                        'port': channel_port,
+                        'capacity': channel_capacity,
+                        'flush_interval': flush_interval,   # seconds output to members is batched for, 0 for none
+                        'limits': limits,   # per user and per channel rates, see ratelimit.py
+                        'rate_limit': RateLimit(limits[2], limits[3]),  # the channel's share of them
+                        'clients': {},  # Active clients in the channel, username -> Session
+                        'queue': OrderedDict(),    # Clients waiting to join the channel, admitted from the front
+                        'lock': TimedLock(self.metrics, channel_name),  # Lock to manage access to the clients and queue
+                        'muted': {},    # username -> monotonic time the mute ends, cleared by a timer
+                        'history': History(self.history_size, self.history_bytes),   # recent chat, replayed to new members
+                        'notify_from': None,    # first queue position with an update due, None when none is
+                        'listener': None    # listening socket, once the engine has opened it
+                    }
+
+    def reload_channels(self):
+        # Applies the config file to the running server. New channels are opened and
+        # ports and capacities change in place; nobody connected is disturbed.
+        try:
+            config = read_config(self.config_file)
+        except ValueError as e:
+            print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Reload failed: {e}")
+            return
+        for channel_name, (channel_port, channel_capacity, flush_interval, limits) in config.items():
+            channel_info = self.channels.get(channel_name)
+            if channel_info is None or channel_port != channel_info['port']:
+                try:
+                    # Bound before anything changes: a port that cannot be had leaves a new
+                    # channel out and a moved one on its old port, and the next /reload
+                    # tries again
+                    listener = self.open_listener(channel_port) if channel_port else None
+                except OSError as e:
+                    print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot open {channel_name} on port {channel_port}: {e}")
+                    if channel_info is None:
+                        continue
+                else:
+                    if channel_info is None:
+                        self.add_channel(channel_name, channel_port, channel_capacity, flush_interval, limits)
+                        self.channels[channel_name]['listener'] = listener
+                        self.open_channel(channel_name)
+                        continue
+                    self.close_listener(channel_name)
+                    channel_info['port'] = channel_port
+                    channel_info['listener'] = listener
+                    self.open_channel(channel_name)
+            # Applies from the next batch on
+            channel_info['flush_interval'] = flush_interval
+            if limits != channel_info['limits']:
+                self.set_limits(channel_name, limits)
+            if channel_capacity != channel_info['capacity']:
+                with channel_info['lock']:
+                    channel_info['capacity'] = channel_capacity
+                # A bigger channel lets the queue in, a smaller one only admits fewer
+                self.admit_waiting(channel_name)
+        for channel_name in self.channels:
+            if channel_name not in config:
+                print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} is no longer configured, it stays open until the server restarts.")
+        print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Reloaded {self.config_file}.")
+
+    def upgrade(self):
+        # Hands the listening sockets, every client socket and all channel state to a new
+        # server process started from the same command line, and exits once it has taken
+        # over. Clients keep their connections and notice nothing.
+        current_time = time.strftime('%H:%M:%S')
+        if not self.pause():
+            self.resume()
+            print(f"[Server message ({current_time}) ] Upgrade failed: the server did not come to a stop.")
+            return
+        old_end, new_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        successor = None
+        try:
+            successor = spawn_successor(new_end)
+            new_end.close()
+            send_state(old_end, *self.export_state())
+            old_end.settimeout(TAKEOVER_TIMEOUT)
+            if old_end.recv(2) != b'ok':
+                raise ConnectionError("the new server exited")
+        except Exception as e:
+            if successor is not None:
+                successor.kill()
+            new_end.close()
+            old_end.close()
+            # The new process may have changed the blocking mode the descriptors share
+            for session in self.registry:
+                session.socket.setblocking(self.blocking_sockets)
+            self.resume()
+            print(f"[Server message ({current_time}) ] Upgrade failed: {e}")
+            return
+        print(f"[Server message ({current_time}) ] Handed over to process {successor.pid}.")
+        self.log_sink.close()
+        sys.stdout.flush()
+        # No cleanup, the sockets belong to the new process now
+        os._exit(0)
+
+    def export_state(self):
+        # Returns (state, fds): plain data for pickling, which refers to sockets and open
+        # files by their index in fds
+        fds = []
+        def descriptor(obj):
+            fds.append(obj.fileno())
+            return len(fds) - 1
+
+        sessions = [session for session in self.registry if session.state != 'closed']
+        index = {id(session): i for i, session in enumerate(sessions)}
+        transfers = {}
+        def transfer_id(transfer):
+            if transfer.id not in transfers:
+                transfers[transfer.id] = {
+                    'file': descriptor(transfer.file), 'name': transfer.name, 'size': transfer.size,
+                    'sender': index.get(id(transfer.sender)), 'sender_name': transfer.sender.username,
+                    'target': transfer.target, 'offset': transfer.offset, 'sent': transfer.sent,
+                    'started': transfer.started, 'last_report': transfer.last_report, 'state': transfer.state}
+            return transfer.id
+
+        session_states = []
+        for session in sessions:
+            outbox = session.outbox
+            chunks = [chunk if isinstance(chunk, bytes) else (transfer_id(chunk.transfer), chunk.header, chunk.offset, chunk.end)
+                      for chunk in outbox.chunks]
+            session_states.append({
+                'socket': descriptor(session.socket), 'addr': session.addr, 'username': session.username,
+                'channel': session.channel, 'state': session.state, 'position': session.position,
+                'history_seq': session.history_seq, 'last_active': session.last_active,
+                'framed': None if session.codec is None else session.codec.framed,
+                'buffer': bytes(session.codec.decoder.buffer) if session.codec is not None and session.codec.framed else b'',
+                'greeting': session.greeting, 'pending': list(session.pending or ()),
+                'chunks': chunks, 'offset': outbox.offset, 'dropped': outbox.dropped,
+                'transfers': [transfer_id(transfer) for transfer in outbox.transfers]})
+
+        channels = {}
+        for channel_name, channel_info in self.channels.items():
+            history = channel_info['history']
+            channels[channel_name] = {
+                'port': channel_info['port'], 'capacity': channel_info['capacity'],
+                'flush_interval': channel_info['flush_interval'], 'limits': channel_info['limits'],
+                'listener': None if channel_info['listener'] is None else descriptor(channel_info['listener']),
+                'clients': [index[id(session)] for session in channel_info['clients'].values() if id(session) in index],
+                'queue': [index[id(session)] for session in channel_info['queue'].values() if id(session) in index],
+                'muted': dict(channel_info['muted']), 'notify_from': channel_info['notify_from'],
+                'history': ([payload.data for payload in history.entries], history.next_seq)}
+
+        state = {'channels': channels, 'sessions': session_states, 'transfers': transfers,
+                 'next_transfer_id': next(self.transfer_ids), 'console': self.console_backlog,
+                 'shared_port': self.shared_port,
+                 'shared_listener': None if self.shared_listener is None else descriptor(self.shared_listener)}
+        return state, fds
+
+    def take_over(self, fd):
+        # Runs in the new process before start(): receives the old server's state. The
+        # old process waits, paused, until resume_adopted() tells it we are serving.
+        if hasattr(signal, 'SIGTTIN'):
+            # The console may end up in a background process group once the old server exits
+            signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        self.takeover_link = socket.socket(fileno=fd)
+        state, fds = receive_state(self.takeover_link)
+        self.adopt(state, fds)
+
+    def adopt(self, state, fds):
+        # Channels take their capacity from the new config; listeners are reused where the
+        # port is unchanged, and channels only the old config had are kept for their members
+        now = time.monotonic()
+        for channel_name, channel_state in state['channels'].items():
+            if channel_name not in self.channels:
+                print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} is no longer configured, it stays open until the server restarts.")
+                self.add_channel(channel_name, channel_state['port'], channel_state['capacity'],
+                                 channel_state['flush_interval'], channel_state['limits'])
+            channel_info = self.channels[channel_name]
+            if channel_state['listener'] is not None:
+                listener = socket.socket(fileno=fds[channel_state['listener']])
+                if channel_info['port'] == channel_state['port']:
+                    listener.setblocking(False)
+                    channel_info['listener'] = listener
+                else:
+                    listener.close()
+            for username, mute_end_time in channel_state['muted'].items():
+                channel_info['muted'][username] = mute_end_time
+                self.timers.schedule(max(0, mute_end_time - now), self.unmute, channel_name, username, mute_end_time)
+            history = channel_info['history']
+            payloads, next_seq = channel_state['history']
+            for data in payloads:
+                history.append(Payload(data))
+            history.next_seq = next_seq
+
+        sessions = []
+        for session_state in state['sessions']:
+            client_socket = socket.socket(fileno=fds[session_state['socket']])
+            client_socket.setblocking(self.blocking_sockets)
+            session = Session(client_socket, session_state['addr'], session_state['channel'],
+                              OutboundQueue(self.outbox_limit, self.overflow_policy))
+            for name in ('username', 'state', 'position', 'history_seq', 'last_active', 'greeting', 'pending'):
+                setattr(session, name, session_state[name])
+            if session_state['framed'] is not None:
+                session.codec = FramedCodec() if session_state['framed'] else RawCodec()
+                if session_state['framed']:
+                    session.codec.decoder.buffer += session_state['buffer']
+            self.registry.add(session)
+            if session.state == 'active':
+                session.afk_timer = self.timers.schedule(max(0, self.afk_timeout - (now - session.last_active)), self.check_afk, session)
+            sessions.append(session)
+
+        transfers = {}
+        for transfer_id, transfer_state in state['transfers'].items():
+            sender = sessions[transfer_state['sender']] if transfer_state['sender'] is not None else None
+            if sender is None:
+                # Gone already, only its name is needed
+                sender = Session(None, None, None, None)
+                sender.username = transfer_state['sender_name']
+                sender.state = 'closed'
+            transfer = Transfer(transfer_id, os.fdopen(fds[transfer_state['file']], 'rb'), transfer_state['name'],
+                                transfer_state['size'], sender, transfer_state['target'],
+                                lambda transfer, event: self.call_soon(self.report_transfer, transfer, event))
+            for name in ('offset', 'sent', 'started', 'last_report', 'state'):
+                setattr(transfer, name, transfer_state[name])
+            transfers[transfer_id] = transfer
+
+        for session, session_state in zip(sessions, state['sessions']):
+            outbox = session.outbox
+            for chunk in session_state['chunks']:
+                if isinstance(chunk, bytes):
+                    outbox.chunks.append(chunk)
+                    outbox.size += len(chunk)
+                else:
+                    transfer_id, header, offset, end = chunk
+                    frame = FileFrame(transfers[transfer_id], offset, end - offset)
+                    frame.header = header
+                    outbox.chunks.append(frame)
+            outbox.offset = session_state['offset']
+            outbox.size -= outbox.offset
+            outbox.dropped = session_state['dropped']
+            outbox.transfers.extend(transfers[transfer_id] for transfer_id in session_state['transfers'])
+
+        for channel_name, channel_state in state['channels'].items():
+            channel_info = self.channels[channel_name]
+            for i in channel_state['clients']:
+                channel_info['clients'][sessions[i].username] = sessions[i]
+            for i in channel_state['queue']:
+                channel_info['queue'][sessions[i].username] = sessions[i]
+            if channel_state['notify_from'] is not None:
+                with channel_info['lock']:
+                    self.queue_changed(channel_name, channel_state['notify_from'])
+
+        if state['shared_listener'] is not None:
+            listener = socket.socket(fileno=fds[state['shared_listener']])
+            if self.shared_port == state['shared_port']:
+                listener.setblocking(False)
+                self.shared_listener = listener
+            else:
+                listener.close()
+        self.transfer_ids = itertools.count(state['next_transfer_id'])
+        self.console_backlog = state['console']
+        self.adopted = sessions
+
+    def resume_adopted(self):
+        # Called by start() once the engine is up: adopted sessions carry on and the old
+        # process is told to exit
+        adopted, self.adopted = self.adopted, []
+        for session in adopted:
+            self.resume_session(session)
+        if self.takeover_link is not None:
+            self.takeover_link.sendall(b'ok')
+            self.takeover_link.close()
+            self.takeover_link = None
+            print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Took over {len(adopted)} connection(s).")
+            # Channels whose capacity grew in the new config let their queues in
+            for channel_name in list(self.channels):
+                self.admit_waiting(channel_name)
 
-            for existing_channel in self.channels.values():
-                if existing_channel['port'] == channel_port:
-                    print(f"Duplicate channel port: {channel_port}")
-                    sys.exit(1)
-
-            self.channels[channel_name] = {
-                            'port': channel_port,
-                            'capacity': channel_capacity,
-                            'clients': [],  # List of active clients in the channel
-                            'queue': [],    # List of clients waiting to join the channel
-                            'lock': threading.Lock()  # Lock to manage access to the clients and queue lists
-                        }
      #shutdown funtionality
     def shutdown(self):
         for channel_name, channel_info in self.channels.items():
-            for client_socket, _, _ in channel_info['clients']:
-                client_socket.close()
+            for session in list(channel_info['clients'].values()):
+                self.close_client(session)
 
+        self.log_sink.close()
         print("[Server message] The server is shutting down.")
         sys.exit(0)
 
+    def log(self, event, text):
+        # Never blocks, the log sink's thread does the writing
+        self.log_sink.log(event, text)
+
     def process_server_commands(self):
         while True:
             #Everything taken from stdin should have whitespace stripped from both sides before being evaluated as a chat message or a command.
-            command = input().strip()
-            #shutdown command
-            if command == "/shutdown":
-                self.shutdown()
-            #mute command
-            if command.startswith("/mute"):
-                try:
-                    _, channel_user, mute_time = command.split(" ", 2)
-                    channel_name, username = channel_user.split(":", 1)
-                    mute_time = int(mute_time)
-
-                    if mute_time <= 0:
-                        raise ValueError("Invalid mute time.")
-
-                    # mute logic implemented in the server_command_handler() function
-
-                    if channel_name in self.channels:
-                        channel_info = self.channels[channel_name]
-                        with channel_info['lock']:
-                            user_in_channel = any(user[1] == username for user in channel_info['clients'])
-                            user_in_queue = any(user[1] == username for user in channel_info['queue'])
-
-                        if user_in_channel or user_in_queue:
-                            mute_end_time = datetime.now() + timedelta(seconds=mute_time)
-                            self.muted[username] = mute_end_time
-
-                            current_time = datetime.now().strftime("%H:%M:%S")
-                            print(f"[Server message ({current_time}) ] Muted {username} for {mute_time} seconds.")
-                            server_msg = f"[Server message ({current_time}) ] You have been muted for {mute_time} seconds."
-                            client_msg = f"[Server message ({current_time}) ] {username} has been muted for {mute_time} seconds."
-
-                            # Send the mute messages to the appropriate clients
-                            for client, user, _ in channel_info['clients']:
-                                if user == username:
-                                    client.send(server_msg.encode('utf-8'))
-                                else:
-                                    client.send(client_msg.encode('utf-8'))
-                        else:
-                            current_time = datetime.now().strftime("%H:%M:%S")
-                            print(f"[Server message ({current_time})] {username} is not here.")
+            try:
+                command = input().strip()
+            except (EOFError, OSError):
+                # No console, or one left behind in the background after an upgrade
+                return
+            self.process_server_command(command)
+
+    def process_server_command(self, command):
+        #shutdown command
+        if command == "/shutdown":
+            self.shutdown()
+        #reload command
+        if command == "/reload":
+            self.reload_channels()
+        #upgrade command
+        if command == "/upgrade":
+            self.upgrade()
+        #stats command
+        if command == "/stats":
+            print('\n'.join(render_stats(self.metrics.snapshot(), self.gauges(), self.structure_sizes())))
+        #mute command
+        if command.startswith("/mute"):
+            try:
+                _, channel_user, mute_time = command.split(" ", 2)
+                channel_name, username = channel_user.split(":", 1)
+                mute_time = int(mute_time)
+
+                if mute_time <= 0:
+                    raise ValueError("Invalid mute time.")
+
+                if channel_name in self.channels:
+                    if self.mute(channel_name, username, mute_time):
+                        print(f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] Muted {username} for {mute_time} seconds.")
                     else:
                         current_time = datetime.now().strftime("%H:%M:%S")
-                        print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
-
-                except ValueError as e:
+                        print(f"[Server message ({current_time})] {username} is not here.")
+                else:
                     current_time = datetime.now().strftime("%H:%M:%S")
-                    print(f"[Server message ({current_time}) ] {e}")
+                    print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
 
+            except ValueError as e:
+                current_time = datetime.now().strftime("%H:%M:%S")
+                print(f"[Server message ({current_time}) ] {e}")
 
-            if command.startswith('/empty'):
-                self.empty_channel(command)
 
+        if command.startswith('/empty'):
+            self.empty_channel(command)
 
-            if command.startswith('/kick '):
-                parts = command.split(':')
-                channel_name = parts[0][6:]
-                username = parts[1]
+        #profiling commands
+        if command.split(' ', 1)[0] in ('/profile', '/memory', '/stacks', '/timing'):
+            self.profile_command(command)
 
-                if channel_name not in self.channels:
-                    print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} does not exist.")
-                    continue
+        #limit command, without rates it shows the current ones
+        if command.startswith('/limit '):
+            channel_name, *rates = command.split()[1:]
+            current_time = datetime.now().strftime("%H:%M:%S")
+            if channel_name != '*' and channel_name not in self.channels:
+                print(f"[Server message ({current_time}) ] {channel_name} does not exist.")
+            elif not rates:
+                for name in self.channels if channel_name == '*' else [channel_name]:
+                    print(f"[Server message ({current_time}) ] Limits for {name}: {describe_limits(self.channels[name]['limits'])}.")
+            else:
+                try:
+                    limits = parse_limits(rates)
+                except ValueError:
+                    print(f"[Server message ({current_time}) ] Invalid limit: {' '.join(rates)}")
+                    return
+                for name in self.channels if channel_name == '*' else [channel_name]:
+                    self.set_limits(name, limits)
+                print(f"[Server message ({current_time}) ] Limits for {channel_name}: {describe_limits(limits)}.")
 
-                channel_info = self.channels[channel_name]
 
-                kicked_user = None
-                with channel_info['lock']:
-                    for client, user, _ in channel_info['clients']:
-                        if user == username:
-                            kicked_user = client
-                            channel_info['clients'].remove((client, user, _))
-                            break
+        if command.startswith('/kick '):
+            parts = command.split(':')
+            channel_name = parts[0][6:]
+            username = parts[1]
+
+            if channel_name not in self.channels:
+                print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} does not exist.")
+                return
+
+            channel_info = self.channels[channel_name]
+
+            with channel_info['lock']:
+                kicked_user = channel_info['clients'].pop(username, None)
+
+            if kicked_user is not None:
+                self.send_to(kicked_user, f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel.".encode('utf-8'))
+                self.close_client(kicked_user)
+                print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Kicked {username}.")
+                self.admit_waiting(channel_name)
+            else:
+                print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} is not in {channel_name}.")
+
+    def profile_command(self, command):
+        # /profile start|stop, /memory [stop], /stacks and /timing on|off, see profiling.py
+        current_time = datetime.now().strftime("%H:%M:%S")
+        if command == '/profile start':
+            if self.profiler.start_sampling():
+                print(f"[Server message ({current_time}) ] Profiling every thread, /profile stop writes the samples.")
+            else:
+                print(f"[Server message ({current_time}) ] A profile is already running.")
+        elif command == '/profile stop':
+            sample_count = self.profiler.sample_count
+            path = self.profiler.stop_sampling()
+            if path is None:
+                print(f"[Server message ({current_time}) ] No profile is running.")
+            else:
+                print(f"[Server message ({current_time}) ] Wrote {sample_count} samples to {path}.")
+        elif command == '/memory':
+            path = self.profiler.memory_diff()
+            if path is None:
+                print(f"[Server message ({current_time}) ] Tracing allocations, /memory again writes what grew since.")
+            else:
+                print(f"[Server message ({current_time}) ] Wrote {path}.")
+        elif command == '/memory stop':
+            if self.profiler.stop_memory():
+                print(f"[Server message ({current_time}) ] Stopped tracing allocations.")
+            else:
+                print(f"[Server message ({current_time}) ] Memory tracing is not running.")
+        elif command == '/stacks':
+            print(f"[Server message ({current_time}) ] Wrote {self.profiler.dump_stacks()}.")
+        elif command == '/timing on':
+            self.command_timing = True
+            print(f"[Server message ({current_time}) ] Timing client commands, /timing off writes the results.")
+        elif command == '/timing off' and self.command_timing:
+            self.command_timing = False
+            snapshot = self.metrics.snapshot()
+            snapshot['counters'] = {}
+            snapshot['histograms'] = {key: buckets for key, buckets in snapshot['histograms'].items()
+                                      if key[0].startswith(COMMAND_METRIC)}
+            path = self.profiler.output_path('timing', 'prom')
+            with open(path, 'w') as output:
+                output.write(render_prometheus(snapshot, {}))
+            print(f"[Server message ({current_time}) ] Wrote {path}.")
+        else:
+            print(f"[Server message ({current_time}) ] Usage: /profile start|stop, /memory [stop], /stacks, /timing on|off")
+
+    def mute(self, channel_name, username, mute_time):
+        # Returns False if the user is neither in the channel nor queued for it
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            user_in_channel = username in channel_info['clients']
+            user_in_queue = username in channel_info['queue']
+        if not user_in_channel and not user_in_queue:
+            return False
+
+        mute_end_time = time.monotonic() + mute_time
+        channel_info['muted'][username] = mute_end_time
+        self.timers.schedule(mute_time, self.unmute, channel_name, username, mute_end_time)
+
+        current_time = datetime.now().strftime("%H:%M:%S")
+        server_msg = f"[Server message ({current_time}) ] You have been muted for {mute_time} seconds."
+        client_msg = f"[Server message ({current_time}) ] {username} has been muted for {mute_time} seconds."
+
+        # Send the mute messages to the appropriate clients
+        with channel_info['lock']:
+            target = channel_info['clients'].get(username)
+        if target is not None:
+            self.send_to(target, server_msg.encode('utf-8'))
+        self.broadcast(channel_name, client_msg.encode('utf-8'), exclude=target)
+        return True
+
+    def unmute(self, channel_name, username, mute_end_time):
+        # A later /mute of the same user set a new end time and has its own timer
+        muted = self.channels[channel_name]['muted']
+        if muted.get(username) == mute_end_time:
+            del muted[username]
 
-                if kicked_user is not None:
-                    kicked_user.send(f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel.".encode('utf-8'))
-                    kicked_user.close()
-                    print(f"[Server message ({time.strftime('%H:%M:%S')}) ] Kicked {username}.")
-                else:
-                    print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} is not in {channel_name}.")
-    
     def empty_channel(self, command):
         _, channel_name = command.split(' ', 1)
         channel_name = channel_name.strip()
@@ -170,290 +649,1643 @@ class ChatServer:
             print(f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] {channel_name} does not exist.")
             return
 
-        with self.channels[channel_name]['lock']:
-            for client_socket, username, addr in self.channels[channel_name]['clients']:
-                client_socket.close()
-                self.channels[channel_name]['clients'].remove((client_socket, username, addr))
-                self.channels.pop(username, None)
-                self.channels[channel_name]['muted'].pop(username, None)
+        self.clear_channel(channel_name)
+        print(f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] {channel_name} has been emptied.")
 
+    def clear_channel(self, channel_name):
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            members, channel_info['clients'] = channel_info['clients'], {}
+            for username, session in members.items():
+                self.close_client(session)
+                channel_info['muted'].pop(username, None)
+
+        self.admit_waiting(channel_name)
+
+
+    # Transport hooks, the event loop engine overrides these
+    def send_to(self, session, data):
+        data = self.encode_for(session, data)
+        self.count_out(session, data)
+        self.push_out(session, data)
+
+    def push_out(self, session, data):
+        # Queues encoded bytes for the client and writes what the socket takes right now.
+        # Never blocks: whatever is left over is finished by the writer thread.
+        outbox = session.outbox
+        with outbox.lock:
+            was_idle = outbox.idle()
+            dropped = outbox.dropped
+            if not outbox.push(data):
+                self.disconnect_slow(session)
+                return
+            if outbox.dropped != dropped:
+                self.metrics.count('dropped_messages', value=outbox.dropped - dropped)
+            if was_idle:
+                delay = self.flush_delay(session)
+                if delay:
+                    # Later messages join the queue until the writer thread flushes it
+                    outbox.held = True
+                    self.writer.write_later(session.socket, outbox, delay)
+                else:
+                    self.write_out(session)
+            elif outbox.batch_full():
+                self.write_out(session)
+
+    def queue_transfer(self, session, transfer):
+        outbox = session.outbox
+        with outbox.lock:
+            was_idle = outbox.idle()
+            outbox.transfers.append(transfer)
+            if was_idle:
+                self.write_out(session)
+
+    def write_out(self, session):
+        # Caller holds the outbox lock and the writer thread is not yet waiting on this socket
+        outbox = session.outbox
+        try:
+            drained = outbox.write(session.socket)
+        except OSError:
+            # The thread reading this socket notices the disconnect and cleans up
+            self.metrics.count('send_errors')
+            outbox.clear()
+            return
+        if not drained:
+            self.writer.want_write(session.socket, outbox)
 
-        print(f"[Server message ({datetime.now().strftime('%H:%M:%S')}) ] {channel_name} has been emptied.")
+    def set_limits(self, channel_name, limits):
+        # Clients pick up their new limits with their next message
+        channel_info = self.channels[channel_name]
+        channel_info['limits'] = limits
+        channel_info['rate_limit'] = RateLimit(limits[2], limits[3])
+
+    def within_limits(self, session, msg, now):
+        # Charges the message to the client's rate limit and, for chat, the channel's.
+        # Returns False, having told the client, if it is over either.
+        channel_name = session.channel
+        channel_info = self.channels[channel_name]
+        if session.limits is not channel_info['limits']:
+            # New to the channel, or its limits changed
+            session.limits = channel_info['limits']
+            session.rate_limit = RateLimit(session.limits[0], session.limits[1])
+        rate_limit = channel_info['rate_limit']
+        if not session.rate_limit.limited() and not rate_limit.limited():
+            return True
+        size = len(msg.encode('utf-8'))
+        if not session.rate_limit.admit(size, now):
+            self.metrics.count('rate_limited', channel_name)
+            limit_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are sending too fast, your message was not delivered."
+            self.send_to(session, limit_msg.encode('utf-8'))
+            self.strike(session, now)
+            return False
+        if rate_limit.limited() and not msg.startswith('/'):
+            with channel_info['lock']:
+                admitted = rate_limit.admit(size, now)
+            if not admitted:
+                self.metrics.count('rate_limited', channel_name)
+                busy_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} is too busy, your message was not delivered."
+                self.send_to(session, busy_msg.encode('utf-8'))
+                return False
+        return True
+
+    def strike(self, session, now):
+        # A client rejected flood_strikes times within about FLOOD_WINDOW seconds is muted
+        if not self.flood_strikes:
+            return
+        if session.strikes is None:
+            session.strikes = TokenBucket(self.flood_strikes / FLOOD_WINDOW, self.flood_strikes)
+        if session.strikes.take(1, now):
+            return
+        session.strikes = None
+        if self.mute(session.channel, session.username, self.flood_mute):
+            self.metrics.count('auto_mutes')
+            self.log('mute', f"[Server message ({time.strftime('%H:%M:%S')}) ] Muted {session.username} in {session.channel} for {self.flood_mute} seconds, sending too fast.")
+
+    def flush_delay(self, session):
+        # Seconds output to the client is held back to go out as one batch, 0 to send now
+        channel_info = self.channels.get(session.channel)
+        return 0 if channel_info is None else channel_info['flush_interval']
+
+    def count_out(self, session, data, messages=1):
+        self.metrics.count('messages_out', session.channel, messages)
+        self.metrics.count('bytes_out', session.channel, len(data))
+
+    def call_soon(self, callback, *args):
+        # Runs callback on the writer thread, where no outbox lock is held
+        self.writer.call_soon(callback, *args)
+
+    def encode_for(self, session, data):
+        return (session.codec or RawCodec()).encode(data)
+
+    def broadcast(self, channel_name, data, exclude=None, history=False):
+        # Encoded once for every member; slow members only fill their own outbound queue.
+        # With history the message is also kept for replay to later members.
+        started = time.perf_counter()
+        payload = Payload(data)
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            if history:
+                channel_info['history'].append(payload)
+            for session in channel_info['clients'].values():
+                if session is not exclude:
+                    self.send_to(session, payload)
+        self.metrics.observe('fanout', time.perf_counter() - started, channel_name)
+
+    def disconnect_slow(self, session):
+        self.log('disconnect', f"[Server message ({time.strftime('%H:%M:%S')}) ] Disconnected {session.username}, too slow to receive messages.")
+        self.metrics.count('slow_disconnects')
+        if session.state == 'queued':
+            session.state = 'closed'
+            session.admitted.set()
+        try:
+            # Wakes the thread blocked in recv() so it cleans up
+            session.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close_client(self, session):
+        if session.admitted is not None:
+            # Wake the thread if it is still waiting in a queue
+            session.state = 'closed'
+            session.admitted.set()
+        with session.outbox.lock:
+            # Last words held back for a batch (kick notices and the like) get one attempt
+            try:
+                session.outbox.write(session.socket)
+            except OSError:
+                pass
+        try:
+            # Closing would not wake the client's thread blocked in poll(), it would wait
+            # on the dead descriptor for good. Its thread closes the socket once it wakes.
+            session.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
+    def open_listener(self, channel_port):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # The kernel spreads incoming connections across every process listening here
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind(("127.0.0.1", channel_port))
+        server_socket.listen(self.backlog)
+        # Both engines accept until the backlog is drained
+        server_socket.setblocking(False)
+        return server_socket
 
 
     def start(self):
 
+        self.log_sink.start()
+        self.pause_wakeup = os.pipe()
+        os.set_blocking(self.pause_wakeup[0], False)
+        self.writer = OutboundWriter()
+        self.spawn(self.writer.run, daemon=True)
+        self.open_scrape_endpoint()
+        self.spawn(self.run_timers, daemon=True)
+
         # Start a new thread for processing server commands
         server_command_thread = threading.Thread(target=self.process_server_commands)
         server_command_thread.daemon = True
         server_command_thread.start()
 
-        for channel_name, channel_info in self.channels.items():
-            channel_info['clients'] = []
-            channel_info['queue'] = []
-            channel_info['lock'] = threading.Lock()
-            channel_thread = threading.Thread(target=self.accept_connections, args=(channel_name,))
-            channel_thread.start()
+        self.open_channels()
+        self.resume_adopted()
 
+    def open_channels(self):
+        if self.shared_port is not None:
+            if self.shared_listener is None:
+                self.shared_listener = self.open_listener(self.shared_port)
+            print(f"Serving {len(self.channels)} channel(s) on port {self.shared_port}")
+            self.listen(self.shared_listener, None)
+        for channel_name in list(self.channels):
+            self.open_channel(channel_name)
 
+    def open_channel(self, channel_name):
+        channel_info = self.channels[channel_name]
+        if channel_info['port'] == 0:
+            # Only reached through the shared port, costs no listener or thread
+            return
+        if channel_info['listener'] is None:
+            channel_info['listener'] = self.open_listener(channel_info['port'])
+        print(f"Channel '{channel_name}' started on port {channel_info['port']}")
+        self.listen(channel_info['listener'], channel_name)
 
-    
-    def accept_connections(self, channel_name):
-        channel_port = self.channels[channel_name]['port']
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(("127.0.0.1", channel_port))
-        server_socket.listen(5)
+    def listen(self, server_socket, channel_name):
+        # channel_name is None for the shared port
+        self.spawn(self.accept_connections, server_socket, channel_name)
+
+    def listener(self, channel_name):
+        if channel_name is None:
+            return self.shared_listener
+        return self.channels[channel_name]['listener']
 
-        print(f"Channel '{channel_name}' started on port {channel_port}")
+    def close_listener(self, channel_name):
+        channel_info = self.channels[channel_name]
+        server_socket, channel_info['listener'] = channel_info['listener'], None
+        if server_socket is None:
+            return
+        try:
+            # Wakes the accepting thread, which sees it is no longer the listener
+            server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        server_socket.close()
 
+    def accept_connections(self, server_socket, channel_name):
         while True:
-            client_socket, addr = server_socket.accept()
-            client_thread = threading.Thread(target=self.handle_client, args=(client_socket, addr, channel_name))
-            client_thread.start()
-    
-    
-
-    
-    def send_server_msg(self, channel_name, msg, exclude_client=None):
+            self.wait_readable(server_socket)
+            if self.listener(channel_name) is not server_socket:
+                return
+            # Drain the backlog, a burst of connects arrives as a single wakeup
+            for _ in range(self.accept_batch):
+                try:
+                    client_socket, addr = server_socket.accept()
+                except OSError:
+                    break
+                client_socket.setblocking(True)
+                # Messages are written whole or gathered into batches already, Nagle
+                # would only hold them back waiting for acknowledgements
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.spawn(self.handle_client, client_socket, addr, channel_name)
+
+    def run_timers(self):
+        while True:
+            if self.pausing:
+                self.park()
+            self.timers.expire()
+            time.sleep(self.timers.timeout() or self.timers.resolution)
+
+    # Threaded mode: every thread started by spawn() stops at a safe point when pause()
+    # is called, so the whole server can be handed to a new process in a consistent state
+
+    def spawn(self, target, *args, daemon=False):
+        with self.pause_cond:
+            self.running += 1
+        thread = threading.Thread(target=self.run_spawned, args=(target, args))
+        thread.daemon = daemon
+        thread.start()
+
+    def run_spawned(self, target, args):
+        try:
+            target(*args)
+        finally:
+            with self.pause_cond:
+                self.running -= 1
+                self.pause_cond.notify_all()
+
+    def wait_readable(self, sock):
+        # Blocks until sock is readable or hung up, parking meanwhile if a pause starts.
+        # A thread blocked in recv() could not be stopped without the client noticing.
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self.pause_wakeup[0], select.POLLIN)
+        while True:
+            if self.pausing:
+                self.park()
+                continue
+            if any(fd != self.pause_wakeup[0] for fd, _ in poller.poll()):
+                return
+
+    def park(self):
+        with self.pause_cond:
+            self.parked += 1
+            self.pause_cond.notify_all()
+            self.pause_cond.wait_for(lambda: not self.pausing)
+            self.parked -= 1
+
+    def pause(self):
+        # Returns once every spawned thread is parked, False if they did not all make it in time
+        with self.pause_cond:
+            self.pausing = True
+        os.write(self.pause_wakeup[1], b'\0')
+        self.writer.call_soon(self.park)
+        for session in self.registry:
+            if session.admitted is not None:
+                # Queued clients' threads wait on this
+                session.admitted.set()
+        with self.pause_cond:
+            return self.pause_cond.wait_for(lambda: self.parked == self.running, TAKEOVER_TIMEOUT)
+
+    def resume(self):
+        try:
+            while os.read(self.pause_wakeup[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.pause_cond:
+            self.pausing = False
+            self.pause_cond.notify_all()
+
+    def resume_session(self, session):
+        # A session taken over from the previous process gets its thread back
+        session.admitted = threading.Event()
+        session.pending = deque(session.pending)
+        self.spawn(self.serve_client, session)
+        with session.outbox.lock:
+            if not session.outbox.idle():
+                self.write_out(session)
+
+
+    def send_server_msg(self, channel_name, msg, exclude=None):
         timestamp = datetime.now().strftime('%H:%M:%S')
         formatted_msg = f"[Server message ({timestamp}) ] {msg}"
-        with self.channels[channel_name]['lock']:
-            for client in self.channels[channel_name]['clients']:
-                if client != exclude_client:
-                    client['socket'].sendall(formatted_msg.encode())
+        self.broadcast(channel_name, formatted_msg.encode(), exclude)
+
+
+    def new_session(self, client_socket, addr, channel_name):
+        session = Session(client_socket, addr, channel_name, OutboundQueue(self.outbox_limit, self.overflow_policy))
+        self.registry.add(session)
+        return session
+
+    def handshake(self, session, data):
+        # Feeds bytes received before the username is known. Returns the username followed
+        # by any messages pipelined behind it, or an empty list while more bytes are needed.
+        if session.codec is None:
+            session.greeting += data
+            session.codec, messages = negotiate(session.greeting)
+            if session.codec is not None:
+                session.greeting = b''
+            return messages
+        return session.codec.feed(data)
+
+    def identify(self, session, msg):
+        # The client's first message is its username, on the shared port preceded by the
+        # channel it wants. Returns False if the client was turned away.
+        if session.channel is None:
+            channel_name, _, msg = msg.partition(' ')
+            if channel_name not in self.channels or not msg:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {channel_name} does not exist."
+                self.send_to(session, error_msg.encode('utf-8'))
+                self.close_client(session)
+                return False
+            session.channel = channel_name
+        session.username = msg
+        return self.register_client(session)
+
+    def register_client(self, session):
+        username, channel_name = session.username, session.channel
+        channel_info = self.channels[channel_name]
+        # Check if the username is already in the channel or its queue
+        with channel_info['lock']:
+            if username in channel_info['clients'] or username in channel_info['queue']:
+                current_time = datetime.now().strftime("%H:%M:%S")
+                error_msg = f"[Server message ({current_time}) ] Cannot connect to the {channel_name} channel."
+                self.send_to(session, error_msg.encode('utf-8'))
+                self.close_client(session)
+                return False
 
+            # Send the welcome message to the client
+            current_time = datetime.now().strftime("%H:%M:%S")
+            welcome_msg = f"[Server message ({current_time}) ] Welcome to the {channel_name} channel, {username}."
+            self.send_to(session, welcome_msg.encode('utf-8'))
 
-    def handle_client(self, client_socket, addr, channel_name):
+            # Add the client to the waiting queue
+            session.state = 'queued'
+            channel_info['queue'][username] = session
+            queue_position = len(channel_info['queue']) - 1
+
+        self.admit_waiting(channel_name, queue_position)
+        return True
+
+    def admit_waiting(self, channel_name, notify_from=None):
+        # Called whenever a seat frees up or someone joins a queue: moves clients from the
+        # head of the queue into the channel while there is room
+        channel_info = self.channels[channel_name]
+        admitted = []
+        moved = False
+        with channel_info['lock']:
+            queue = channel_info['queue']
+            while queue and len(channel_info['clients']) < channel_info['capacity']:
+                username, session = queue.popitem(last=False)
+                moved = True
+                if session.state != 'queued':
+                    continue
+                if not self.is_connected(session.socket):
+                    # Hung up while waiting, nobody is reading its socket
+                    self.close_client(session)
+                    continue
+                channel_info['clients'][username] = session
+                session.state = 'active'
+                session.position = None
+                # Under the lock, so no broadcast is both replayed and delivered live
+                self.replay_history(session)
+                admitted.append(session)
+
+            if moved:
+                self.queue_changed(channel_name)
+            elif notify_from is not None:
+                self.notify_queue_positions(channel_name, notify_from)
+
+        for session in admitted:
+            self.on_admitted(session)
+
+    def queue_changed(self, channel_name, start=0):
+        # Caller holds the channel lock. Everyone from start on moved up, they are told by
+        # a timer so that departures in quick succession are folded into one update.
         channel_info = self.channels[channel_name]
-        channel_info['muted'] = {}
-        username = None
-        client_removed = False
+        if channel_info['notify_from'] is None:
+            channel_info['notify_from'] = start
+            self.timers.schedule(QUEUE_NOTIFY_DELAY, self.flush_queue_positions, channel_name)
+        else:
+            channel_info['notify_from'] = min(channel_info['notify_from'], start)
 
+    def flush_queue_positions(self, channel_name):
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            start, channel_info['notify_from'] = channel_info['notify_from'], None
+            if start is not None:
+                self.notify_queue_positions(channel_name, start)
+
+    def replay_history(self, session, before=None):
+        # Caller holds the channel lock. Sends the page of channel history older than
+        # sequence number before (all of it by default) in a single write and returns
+        # how many messages it held.
+        history = self.channels[session.channel]['history']
+        payloads, session.history_seq = history.page(history.next_seq if before is None else before, self.replay_count)
+        if payloads:
+            data = session.codec.encode_many(payloads)
+            self.count_out(session, data, len(payloads))
+            self.push_out(session, data)
+        return len(payloads)
+
+    def notify_queue_positions(self, channel_name, start=0):
+        # Caller holds the channel lock. Only clients whose position moved are told.
+        queue = self.channels[channel_name]['queue']
+        for queue_position, session in enumerate(itertools.islice(queue.values(), start, None), start):
+            if session.position == queue_position:
+                continue
+            session.position = queue_position
+            msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are in the waiting queue and there are {queue_position} user(s) ahead of you."
+            self.send_to(session, msg.encode('utf-8'))
+
+    def is_connected(self, client_socket):
+        try:
+            return client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+    def on_admitted(self, session):
+        # last_active is when the client joined the queue
+        now = time.monotonic()
+        self.metrics.observe('queue_wait', now - session.last_active, session.channel)
+        session.last_active = now
+        self.timers.cancel(session.afk_timer)
+        session.afk_timer = self.timers.schedule(self.afk_timeout, self.check_afk, session)
+        self.announce_join(session)
+        if session.admitted is not None:
+            # Threaded mode: the client's thread has been waiting for this since it was queued
+            session.admitted.set()
+
+    def check_afk(self, session):
+        # Messages only move last_active, the timer is re-armed here for the time left
+        session.afk_timer = None
+        if session.state != 'active':
+            return
+        idle = time.monotonic() - session.last_active
+        if idle < self.afk_timeout:
+            session.afk_timer = self.timers.schedule(self.afk_timeout - idle, self.check_afk, session)
+            return
+        self.announce_afk(session)
+        self.disconnect_idle(session)
 
+    def disconnect_idle(self, session):
         try:
-            # Receive the client's username
-            username = client_socket.recv(1024).decode('utf-8')
-            # Check if the username is already in the channel
-            with channel_info['lock']:
-                if any(user[1] == username for user in channel_info['clients']):
-                    current_time = datetime.now().strftime("%H:%M:%S")
-                    error_msg = f"[Server message ({current_time}) ] Cannot connect to the {channel_name} channel."
-                    client_socket.send(error_msg.encode('utf-8'))
-                    client_socket.close()
-                    return
+            # Wakes the thread blocked in recv() so it cleans up
+            session.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def remove_client(self, session):
+        # Takes the client out of its channel or queue and lets the next one in
+        channel_name, username = session.channel, session.username
+        if channel_name is None:
+            # Left the shared port before naming a channel
+            session.state = 'closed'
+            self.registry.remove(session)
+            return
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            if channel_info['clients'].get(username) is session:
+                del channel_info['clients'][username]
+            elif channel_info['queue'].get(username) is session:
+                del channel_info['queue'][username]
+                self.queue_changed(channel_name, session.position or 0)
+        session.state = 'closed'
+        self.timers.cancel(session.afk_timer)
+        with session.outbox.lock:
+            # Closes the files of transfers the client will not receive now
+            session.outbox.clear()
+        self.registry.remove(session)
+        self.admit_waiting(channel_name)
+
+    def gauges(self):
+        return {channel_name: self.channel_counts(channel_name) for channel_name in self.channels}
+
+    def open_scrape_endpoint(self):
+        # Prometheus text on a local unix socket, one rendering per connection
+        if self.metrics_socket is None:
+            return
+        listener = open_scrape_socket(self.metrics_socket)
+        collect = lambda: render_prometheus(self.metrics.snapshot(), self.gauges(), self.structure_sizes())
+        scrape_thread = threading.Thread(target=serve_scrapes, args=(listener, collect))
+        scrape_thread.daemon = True
+        scrape_thread.start()
+
+    def structure_sizes(self):
+        # Entries in the long-lived structures that grow with clients coming and going and
+        # should shrink again as they leave. soak.py watches them for leaks.
+        channels = list(self.channels.values())
+        return {
+            'sessions': len(self.registry),
+            'members': sum(len(channel_info['clients']) for channel_info in channels),
+            'queued': sum(len(channel_info['queue']) for channel_info in channels),
+            'muted': sum(len(channel_info['muted']) for channel_info in channels),
+            'timers': self.timers.pending,
+            'metric_shards': len(self.metrics.shards),
+        }
+
+    def channel_counts(self, channel_name):
+        # (members, capacity, queue length) as /list shows them
+        channel_info = self.channels[channel_name]
+        return len(channel_info['clients']), channel_info['capacity'], len(channel_info['queue'])
 
-                # Add the client to the waiting queue
-                channel_info['queue'].append((client_socket, username, addr))
+    def find_member(self, channel_name, username):
+        channel_info = self.channels[channel_name]
+        with channel_info['lock']:
+            return channel_info['clients'].get(username)
 
+    def switch_channel(self, session, new_channel_name):
+        # Moves the client to the back of another channel's queue. Returns the channel
+        # the client is in afterwards.
+        username, channel_name = session.username, session.channel
+        channel_info = self.channels[channel_name]
+        new_channel_info = self.channels[new_channel_name]
+        with new_channel_info['lock']:
+            if username in new_channel_info['clients'] or username in new_channel_info['queue']:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot switch to the {new_channel_name} channel."
+                self.send_to(session, error_msg.encode('utf-8'))
+                return channel_name
+
+            # Remove the client from the current channel or queue
+            with channel_info['lock']:
+                if channel_info['clients'].get(username) is session:
+                    del channel_info['clients'][username]
+                    leave_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel."
+                    self.log('leave', leave_msg)
+                    leave_payload = Payload(leave_msg.encode('utf-8'))
+                    for member in channel_info['clients'].values():
+                        self.send_to(member, leave_payload)
+
+                elif channel_info['queue'].get(username) is session:
+                    del channel_info['queue'][username]
+
+            # Add the client to the new channel's waiting queue
+            session.channel = new_channel_name
+            session.state = 'queued'
+            session.position = None
+            session.last_active = time.monotonic()
+            new_channel_info['queue'][username] = session
+            queue_position = len(new_channel_info['queue']) - 1
+
+        # Hand the freed seat on and settle the new queue entry straight away
+        self.admit_waiting(channel_name)
+        self.admit_waiting(new_channel_name, queue_position)
+        return new_channel_name
+
+    def upload_path(self, file_path):
+        # The file /send streams for file_path, or None unless it names a file inside
+        # --upload-dir. Absolute paths, .. and symlinks leading out of it are refused.
+        if self.upload_dir is None or not file_path or os.path.isabs(file_path):
+            return None
+        if '..' in file_path.replace('\\', '/').split('/'):
+            return None
+        path = os.path.realpath(os.path.join(self.upload_dir, file_path))
+        if os.path.commonpath([path, self.upload_dir]) != self.upload_dir or not os.path.isfile(path):
+            return None
+        return path
+
+    def send_file(self, session, target, file_path, upload_path):
+        # Queues the file on the target's outbound queue and returns straight away. The file
+        # is streamed from disk one chunk frame at a time, in between the target's chat.
+        # upload_path is file_path as upload_path() resolved it, file_path is what users see.
+        if not target.codec.framed:
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target.username} cannot receive files."
+            self.send_to(session, error_msg.encode('utf-8'))
+            return
+        try:
+            file = open(upload_path, 'rb')
+        except OSError:
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot read {file_path}."
+            self.send_to(session, error_msg.encode('utf-8'))
+            return
+        size = os.fstat(file.fileno()).st_size
+        if size > self.max_file_size:
+            file.close()
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {file_path} is larger than the {format_size(self.max_file_size)} limit."
+            self.send_to(session, error_msg.encode('utf-8'))
+            return
 
-            # Send the welcome message to the client
-            current_time = datetime.now().strftime("%H:%M:%S")
-            welcome_msg = f"[Server message ({current_time}) ] Welcome to the {channel_name} channel, {username}."
-            client_socket.send(welcome_msg.encode('utf-8'))
+        transfer = Transfer(next(self.transfer_ids), file, file_path, size, session, target.username,
+                            lambda transfer, event: self.call_soon(self.report_transfer, transfer, event))
+        start_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Sending {file_path} ({format_size(size)}) to {target.username}."
+        self.send_to(session, start_msg.encode('utf-8'))
+        self.queue_transfer(target, transfer)
+
+    def report_transfer(self, transfer, event):
+        sender = transfer.sender
+        rate = format_size(transfer.throughput())
+        if event == 'progress':
+            percent = transfer.sent * 100 // max(transfer.size, 1)
+            msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Sending {transfer.name} to {transfer.target}: {percent}% ({rate}/s)."
+        elif event == 'done':
+            msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You sent {transfer.name} to {transfer.target} ({format_size(transfer.size)} in {transfer.elapsed():.1f}s, {rate}/s)."
+            self.log('transfer', f"[Server message ({time.strftime('%H:%M:%S')}) ] {sender.username} sent {transfer.name} to {transfer.target}.")
+        else:
+            msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Sending {transfer.name} to {transfer.target} failed after {format_size(transfer.sent)}."
+        if sender.state != 'closed':
+            self.send_to(sender, msg.encode('utf-8'))
+
+    def announce_join(self, session):
+        # Announce the client joining the channel
+        join_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {session.username} has joined the channel."
+        self.log('join', join_msg)
+        self.broadcast(session.channel, join_msg.encode('utf-8'), exclude=session)
+
+    def announce_afk(self, session):
+        # Handle AFK clients (idle)
+        afk_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {session.username} went AFK."
+        self.log('afk', afk_msg)
+        self.metrics.count('afk_disconnects')
+        self.broadcast(session.channel, afk_msg.encode('utf-8'), exclude=session)
 
 
+    def handle_client(self, client_socket, addr, channel_name):
+        session = self.new_session(client_socket, addr, channel_name)
+        session.admitted = threading.Event()
+        # Messages received but not handled yet, kept on the session for a handoff
+        session.pending = deque()
+        self.serve_client(session)
 
+    def serve_client(self, session):
+        client_socket, addr, messages = session.socket, session.addr, session.pending
 
-            while True:
-                # Check if the client is at the front of the queue and if there is room in the channel
-                with channel_info['lock']:
-                    if channel_info['queue'][0] == (client_socket, username, addr) and len(channel_info['clients']) < channel_info['capacity']:
-                        channel_info['clients'].append((client_socket, username, addr))
-                        channel_info['queue'].pop(0)
-                        break
+        try:
+            if session.state == 'handshake':
+                # Receive the client's username, framed clients may pipeline messages behind it
+                while not messages:
+                    self.wait_readable(client_socket)
+                    data = client_socket.recv(session.codec.recv_size if session.codec else 1024)
+                    if not data:
+                        self.registry.remove(session)
+                        client_socket.close()
+                        return
+                    self.metrics.count('bytes_in', session.channel, len(data))
+                    messages.extend(self.handshake(session, data))
+                if not self.identify(session, messages.popleft()):
+                    self.registry.remove(session)
+                    client_socket.close()
+                    return
 
-                    queue_position = channel_info['queue'].index((client_socket, username, addr))
-                    msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are in the waiting queue and there are {queue_position} user(s) ahead of you."
-                    client_socket.send(msg.encode('utf-8'))
+            # Main loop for receiving and forwarding messages, parked while waiting in a queue
+            while self.wait_for_admission(session):
+                try:
+                    if self.pausing:
+                        self.park()
+                        continue
 
-                time.sleep(1)
+                    if not messages:
+                        self.wait_readable(client_socket)
+                        data = client_socket.recv(session.codec.recv_size)
 
-            # Announce the client joining the channel
-            join_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has joined the channel."
-            print(join_msg)
-            for client, _, _ in channel_info['clients']:
-                if client != client_socket:
-                    client.send(join_msg.encode('utf-8'))
+                        if not data:
+                            break
 
-            # Main loop for receiving and forwarding messages
-            while True:
-                try:
-                    # Set a timeout of 100 seconds for receiving messages
-                    client_socket.settimeout(100)
-                    msg = client_socket.recv(1024).decode('utf-8')
-                    client_socket.settimeout(None)
+                        self.metrics.count('bytes_in', session.channel, len(data))
+                        # Every complete frame in the buffer is handled before the next recv
+                        messages.extend(session.codec.feed(data))
+                        continue
 
+                    msg = messages.popleft()
                     if not msg:
+                        continue
+                    if self.handle_message(session, msg) is None:
                         break
 
-                    # Check if the client is muted
-                    with channel_info['lock']:
-                        if username in channel_info['muted']:
-                            remaining_time = int(channel_info['muted'][username] - time.time())
-                            if remaining_time > 0:
-                                mute_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are still muted for {remaining_time} seconds."
-                                client_socket.send(mute_msg.encode('utf-8'))
-                                continue
-                            else:
-                                del channel_info['muted'][username]
-                    #quit command
-                    if msg == '/quit':
-                        quit_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel."
-                        print(quit_msg)
-                        with channel_info['lock']:
-                            for client, _, _ in channel_info['clients']:
-                                if client != client_socket:
-                                    client.send(quit_msg.encode('utf-8'))
-                        break
-                    #list command
-                    elif msg == '/list':
-                        list_msg = []
-                        for channel in self.channels:
-                            current = len(self.channels[channel]['clients'])
-                            capacity = self.channels[channel]['capacity']
-                            queue_length = len(self.channels[channel]['queue'])
-                            list_msg.append(f"[ Channel ] {channel} {current}/{capacity}/{queue_length}")
-                        client_socket.send('\n'.join(list_msg).encode('utf-8'))
-
-                    elif msg.startswith('/switch '):
-                        new_channel_name = msg.split(' ')[1]
-
-                        if new_channel_name not in self.channels:
-                            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {new_channel_name} does not exist."
-                            client_socket.send(error_msg.encode('utf-8'))
-                        else:
-                            new_channel_info = self.channels[new_channel_name]
-                            with new_channel_info['lock']:
-                                if any(user[1] == username for user in new_channel_info['clients']) or \
-                                        any(user[1] == username for user in new_channel_info['queue']):
-                                    error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot switch to the {new_channel_name} channel."
-                                    client_socket.send(error_msg.encode('utf-8'))
-                                else:
-                                    # Remove the client from the current channel or queue
-                                    with channel_info['lock']:
-                                        if (client_socket, username, addr) in channel_info['clients']:
-                                            channel_info['clients'].remove((client_socket, username, addr))
-                                            leave_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel."
-                                            print(leave_msg)
-                                            for client, _, _ in channel_info['clients']:
-                                                client.send(leave_msg.encode('utf-8'))
-
-                                        if (client_socket, username, addr) in channel_info['queue']:
-                                            channel_info['queue'].remove((client_socket, username, addr))
-
-                                    # Add the client to the new channel's waiting queue
-                                    new_channel_info['queue'].append((client_socket, username, addr))
-
-                                    # Update the channel_name variable for the new channel
-                                    channel_name = new_channel_name
-                                    channel_info = self.channels[channel_name]
-
-                    elif msg.startswith('/send '):
-                        parts = msg.split(' ')
-                        target_username = parts[1]
-                        file_path = ' '.join(parts[2:])
-
-                        if not os.path.exists(file_path):
-                            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {file_path} does not exist."
-                            client_socket.send(error_msg.encode('utf-8'))
-
-                        target_socket = None
-                        with channel_info['lock']:
-                            for client, user, _ in channel_info['clients']:
-                                if user == target_username:
-                                    target_socket = client
-                                    break
-
-                        if target_socket is None:
-                            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target_username} is not here."
-                            client_socket.send(error_msg.encode('utf-8'))
-
-                        elif os.path.exists(file_path):
-                            success_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You sent {file_path} to {target_username}."
-                            client_socket.send(success_msg.encode('utf-8'))
-
-                            server_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} sent {file_path} to {target_username}."
-                            print(server_msg)
-
-                            self.send_file(client_socket, target_socket, file_path)
-                    
-                    
-                    
-                    if msg.startswith('/whisper '):
-                        whisper_parts = msg.split(maxsplit=2)
-                        if len(whisper_parts) >= 3:
-                            target_username, whisper_msg = whisper_parts[1], whisper_parts[2]
-                            target_client = None
-
-                            with channel_info['lock']:
-                                for client, user, _ in channel_info['clients']:
-                                    if user == target_username:
-                                        target_client = client
-                                        break
-
-                            if target_client:
-                                whisper_msg = f"[ {username} whispers to you: ({time.strftime('%H:%M:%S')}) ] {whisper_msg}"
-                                target_client.send(whisper_msg.encode('utf-8'))
-                            else:
-                                not_here_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target_username} is not here."
-                                client_socket.send(not_here_msg.encode('utf-8'))
-
-                            print(f"[ {username} whispers to {target_username}: ({time.strftime('%H:%M:%S')}) ] {whisper_msg}")
-
-                        else:
-                            # Invalid whisper command, do nothing
-                            pass
-                    else:
-                        formatted_msg = f"[ {username} ({time.strftime('%H:%M:%S')}) ] {msg}"
-                        print(formatted_msg)
-                        for client, _, _ in channel_info['clients']:
-                            if client != client_socket:
-                                client.send(formatted_msg.encode('utf-8'))
-
-                except socket.timeout:
-                    # Handle AFK clients (idle)
-                    afk_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} went AFK."
-                    print(afk_msg)
-                    with channel_info['lock']:
-                        for client, _, _ in channel_info['clients']:
-                            if client != client_socket:
-                                client.send(afk_msg.encode('utf-8'))
-                    break
-
                 except Exception as e:
-                    print(f"Error handling client {username} at {addr}: {e}")
+                    self.log('error', f"Error handling client {session.username} at {addr}: {e}")
                     break
 
 
 
             # Remove the client from the channel and queue
-            with channel_info['lock']:
-                channel_info['clients'].remove((client_socket, username, addr))
-                if (client_socket, username, addr) in channel_info['queue']:
-                    channel_info['queue'].remove((client_socket, username, addr))
+            self.remove_client(session)
 
             client_socket.close()
         except Exception as e:
-            if not client_removed:
-                channel_name = self.channels.get(username)
-                if channel_name:
-                    channel_info = self.channels[channel_name]
-                    with channel_info['lock']:
-                        channel_info['clients'].remove((client_socket, username, addr))
-            print(f"Error handling client {username} at {addr}: {str(e)}")
+            self.remove_client(session)
+            self.log('error', f"Error handling client {session.username} at {addr}: {str(e)}")
+
+    def wait_for_admission(self, session):
+        # The admitting thread flips the state before setting the event
+        while session.state == 'queued':
+            session.admitted.wait()
+            session.admitted.clear()
+            if self.pausing:
+                self.park()
+        return session.state == 'active'
+
+
+    def handle_message(self, session, msg):
+        # Returns the channel the client is in afterwards, or None once it has quit
+        if not self.command_timing:
+            return self.process_message(session, msg)
+        started = time.perf_counter()
+        channel_name = self.process_message(session, msg)
+        self.metrics.observe(COMMAND_METRIC + command_name(msg), time.perf_counter() - started, session.channel)
+        return channel_name
+
+    def process_message(self, session, msg):
+        username, channel_name = session.username, session.channel
+        self.metrics.count('messages_in', channel_name)
+        session.last_active = time.monotonic()
+
+        # Check if the client is muted, expired mutes are removed by their timer. Checked
+        # first, so a muted flooder is not charged, struck and muted over and over.
+        mute_end_time = self.channels[channel_name]['muted'].get(username)
+        if mute_end_time is not None:
+            remaining_time = mute_end_time - session.last_active
+            if remaining_time > 0:
+                mute_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are still muted for {math.ceil(remaining_time)} seconds."
+                self.send_to(session, mute_msg.encode('utf-8'))
+                return channel_name
+
+        # A flood is turned away before it costs a fan-out
+        if msg != '/quit' and not self.within_limits(session, msg, session.last_active):
+            return channel_name
+        #quit command
+        if msg == '/quit':
+            quit_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel."
+            self.log('leave', quit_msg)
+            self.broadcast(channel_name, quit_msg.encode('utf-8'), exclude=session)
+            return None
+        #list command
+        elif msg == '/list':
+            list_msg = []
+            for channel in self.channels:
+                current, capacity, queue_length = self.channel_counts(channel)
+                list_msg.append(f"[ Channel ] {channel} {current}/{capacity}/{queue_length}")
+            self.send_to(session, '\n'.join(list_msg).encode('utf-8'))
+
+        #history command, each one pages further back
+        elif msg == '/history':
+            with self.channels[channel_name]['lock']:
+                if not self.replay_history(session, session.history_seq):
+                    no_history_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] No earlier messages in {channel_name}."
+                    self.send_to(session, no_history_msg.encode('utf-8'))
+
+        elif msg.startswith('/switch '):
+            new_channel_name = msg.split(' ')[1]
+
+            if new_channel_name not in self.channels:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {new_channel_name} does not exist."
+                self.send_to(session, error_msg.encode('utf-8'))
+            else:
+                channel_name = self.switch_channel(session, new_channel_name)
+
+        elif msg.startswith('/send '):
+            parts = msg.split(' ')
+            target_username = parts[1]
+            file_path = ' '.join(parts[2:])
+
+            # Only files inside --upload-dir, named relative to it, are ever read
+            upload_path = self.upload_path(file_path)
+            target = None if upload_path is None else self.find_member(channel_name, target_username)
+
+            if self.upload_dir is None:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] File transfers are not enabled on this server."
+                self.send_to(session, error_msg.encode('utf-8'))
+            elif upload_path is None:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {file_path} does not exist."
+                self.send_to(session, error_msg.encode('utf-8'))
+            elif target is None:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target_username} is not here."
+                self.send_to(session, error_msg.encode('utf-8'))
+            else:
+                self.send_file(session, target, file_path, upload_path)
+
+        elif msg.startswith('/whisper '):
+            whisper_parts = msg.split(maxsplit=2)
+            if len(whisper_parts) >= 3:
+                target_username, whisper_msg = whisper_parts[1], whisper_parts[2]
+
+                target = self.find_member(channel_name, target_username)
+
+                if target:
+                    whisper_msg = f"[ {username} whispers to you: ({time.strftime('%H:%M:%S')}) ] {whisper_msg}"
+                    self.send_to(target, whisper_msg.encode('utf-8'))
+                else:
+                    not_here_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target_username} is not here."
+                    self.send_to(session, not_here_msg.encode('utf-8'))
 
+                self.log('whisper', f"[ {username} whispers to {target_username}: ({time.strftime('%H:%M:%S')}) ] {whisper_msg}")
+
+            else:
+                # Invalid whisper command, do nothing
+                pass
+        else:
+            formatted_msg = f"[ {username} ({time.strftime('%H:%M:%S')}) ] {msg}"
+            self.log('chat', formatted_msg)
+            self.broadcast(channel_name, formatted_msg.encode('utf-8'), exclude=session, history=True)
+
+        return channel_name
+
+
+class EventLoopChatServer(ChatServer):
+    # Serves every channel listener, client and the admin console from one
+    # selector loop on the main thread instead of a thread per socket
+    blocking_sockets = False
+
+    def __init__(self, config_file, **options):
+        super().__init__(config_file, **options)
+        self.selector = None
+        self.closing = []       # sessions to tear down once the current event is done
+        self.deferred = []      # callbacks to run once the current event is done
+        self.flush_timers = TimerWheel(FLUSH_RESOLUTION)   # batched outboxes waiting for their flush
+
+    def start(self):
+        self.log_sink.start()
+        self.selector = selectors.DefaultSelector()
+        self.open_channels()
+        self.open_console()
+        self.open_scrape_endpoint()
+        self.resume_adopted()
+        # Commands the old process had read but not run yet
+        self.call_soon(self.run_server_commands)
+        self.run()
+
+    def listen(self, server_socket, channel_name):
+        self.selector.register(server_socket, selectors.EVENT_READ, (self.accept_clients, channel_name))
+
+    def close_listener(self, channel_name):
+        channel_info = self.channels[channel_name]
+        server_socket, channel_info['listener'] = channel_info['listener'], None
+        if server_socket is None:
+            return
+        self.selector.unregister(server_socket)
+        server_socket.close()
+
+    def pause(self):
+        # Nothing else runs while a console command does
+        return True
+
+    def resume(self):
+        pass
+
+    def resume_session(self, session):
+        self.selector.register(session.socket, selectors.EVENT_READ, (self.handle_events, session))
+        if not session.outbox.idle():
+            self.flush(session)
+
+    def open_console(self):
+        try:
+            self.selector.register(sys.stdin, selectors.EVENT_READ, (self.read_server_commands, None))
+        except (PermissionError, ValueError):
+            # stdin is a regular file or closed, run without a console
+            pass
+
+    def run(self):
+        while True:
+            timeouts = [timeout for timeout in (self.timers.timeout(), self.flush_timers.timeout()) if timeout is not None]
+            for key, events in self.selector.select(min(timeouts, default=None)):
+                callback, data = key.data
+                try:
+                    callback(key.fileobj, data, events)
+                except SystemExit:
+                    raise
+                except Exception as e:
+                    self.log('error', f"Error in event loop: {e}")
+                self.reap()
+                self.run_deferred()
+
+            self.timers.expire()
+            self.flush_timers.expire()
+            self.reap()
+            self.run_deferred()
+
+    def structure_sizes(self):
+        sizes = super().structure_sizes()
+        sizes['registered'] = len(self.selector.get_map())
+        return sizes
+
+    def call_soon(self, callback, *args):
+        self.deferred.append((callback, args))
+
+    def run_deferred(self):
+        while self.deferred:
+            callback, args = self.deferred.pop(0)
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log('error', f"Error in event loop: {e}")
+            self.reap()
+
+    def read_server_commands(self, stdin, _, events):
+        try:
+            data = os.read(stdin.fileno(), 4096)
+        except OSError:
+            # A console left behind in the background after an upgrade
+            data = b''
+        if not data:
+            # stdin closed, keep serving without a console
+            self.selector.unregister(stdin)
+            return
+        self.console_backlog += data
+        self.run_server_commands()
+
+    def run_server_commands(self):
+        while b'\n' in self.console_backlog:
+            line, self.console_backlog = self.console_backlog.split(b'\n', 1)
+            self.process_server_command(line.decode('utf-8', 'replace').strip())
+
+    def accept_clients(self, server_socket, channel_name, events):
+        # Drain the backlog, a burst of connects arrives as a single readiness event
+        for _ in range(self.accept_batch):
+            try:
+                client_socket, addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = self.new_session(client_socket, addr, channel_name)
+            session.pending = []
+            self.selector.register(client_socket, selectors.EVENT_READ, (self.handle_events, session))
+
+    def handle_events(self, client_socket, session, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush(session)
+        if events & selectors.EVENT_READ and session.state != 'closed':
+            self.read_client(session)
+
+    def read_client(self, session):
+        try:
+            data = session.socket.recv(session.codec.recv_size if session.codec else 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.drop(session)
+            return
 
-def main(config_file):
-    server = ChatServer(config_file)
+        self.metrics.count('bytes_in', session.channel, len(data))
+        try:
+            if session.state == 'handshake':
+                messages = self.handshake(session, data)
+                if not messages:
+                    return
+                if not self.identify(session, messages.pop(0)):
+                    return
+            else:
+                messages = session.codec.feed(data)
+        except ProtocolError as e:
+            self.log('error', f"Error handling client {session.username} at {session.addr}: {e}")
+            self.drop(session)
+            return
+
+        # Every complete frame from this recv is handled in one go
+        for msg in messages:
+            if not msg:
+                continue
+            if session.state == 'queued':
+                # Held back until admitted, the threaded engine does not read either
+                if len(session.pending) < QUEUED_MESSAGE_LIMIT:
+                    session.pending.append(msg)
+                    continue
+                self.metrics.count('queued_dropped', session.channel)
+                session.pending_dropped += 1
+                if session.pending_dropped == 1:
+                    # Told once per stay in the queue, a flood is not answered line for line
+                    drop_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are in the waiting queue, messages past the first {QUEUED_MESSAGE_LIMIT} are dropped until you are admitted."
+                    self.send_to(session, drop_msg.encode('utf-8'))
+            elif session.state == 'active':
+                self.dispatch(session, msg)
+
+    def dispatch(self, session, msg):
+        try:
+            channel_name = self.handle_message(session, msg)
+        except Exception as e:
+            self.log('error', f"Error handling client {session.username} at {session.addr}: {e}")
+            self.drop(session)
+            return
+
+        if channel_name is None:
+            self.drop(session)
+
+    def on_admitted(self, session):
+        super().on_admitted(session)
+        pending, session.pending = session.pending, []
+        session.pending_dropped = 0
+        for msg in pending:
+            if session.state != 'active':
+                break
+            self.dispatch(session, msg)
+
+    def send_to(self, session, data):
+        if session.state != 'closed':
+            super().send_to(session, data)
+
+    def push_out(self, session, data):
+        if session.state == 'closed':
+            return
+        outbox = session.outbox
+        was_idle = outbox.idle()
+        dropped = outbox.dropped
+        if not outbox.push(data):
+            self.disconnect_slow(session)
+            return
+        if outbox.dropped != dropped:
+            self.metrics.count('dropped_messages', value=outbox.dropped - dropped)
+        if was_idle:
+            # Still waiting for EVENT_WRITE or a batch flush otherwise
+            delay = self.flush_delay(session)
+            if delay:
+                outbox.held = True
+                self.flush_timers.schedule(delay, self.flush_batch, session)
+            else:
+                self.flush(session)
+        elif outbox.batch_full():
+            self.flush(session)
+
+    def queue_transfer(self, session, transfer):
+        outbox = session.outbox
+        was_idle = outbox.idle()
+        outbox.transfers.append(transfer)
+        if was_idle:
+            self.flush(session)
+
+    def flush_batch(self, session):
+        # Already written if the batch filled up early
+        if session.state != 'closed' and session.outbox.held:
+            self.flush(session)
+
+    def flush(self, session):
+        client_socket = session.socket
+        try:
+            drained = session.outbox.write(client_socket)
+        except OSError:
+            self.metrics.count('send_errors')
+            self.drop(session)
+            return
+        events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if self.selector.get_key(client_socket).events != events:
+            self.selector.modify(client_socket, events, (self.handle_events, session))
+
+    def disconnect_slow(self, session):
+        self.log('disconnect', f"[Server message ({time.strftime('%H:%M:%S')}) ] Disconnected {session.username}, too slow to receive messages.")
+        self.metrics.count('slow_disconnects')
+        session.outbox.clear()
+        self.drop(session)
+
+    def close_client(self, session):
+        self.drop(session)
+
+    def disconnect_idle(self, session):
+        self.drop(session)
+
+    def drop(self, session):
+        # Only marks the session, callers may be iterating over the member
+        # dicts or holding a channel lock; reap() does the actual teardown
+        if session.state == 'closed':
+            return
+        session.state = 'closed'
+        self.closing.append(session)
+
+    def reap(self):
+        while self.closing:
+            session = self.closing.pop()
+            client_socket = session.socket
+            if session.outbox.chunks:
+                # Last words (kick notices and the like) get one non-blocking attempt
+                try:
+                    session.outbox.write(client_socket)
+                except OSError:
+                    pass
+            self.selector.unregister(client_socket)
+            client_socket.close()
+            self.remove_client(session)
+
+
+class ShardWorker(EventLoopChatServer):
+    # One of the worker processes started by --workers N. Each worker listens on every
+    # channel port and serves the clients the kernel hands it. Channel membership and
+    # waiting queues are owned by the ShardBroker in the parent process, so capacity,
+    # /list and the admin commands hold across all workers.
+    reuse_port = True
+
+    def __init__(self, config_file, **options):
+        super().__init__(config_file, **options)
+        self.shard_id = None
+        self.link = None
+        self.link_socket = None
+        self.refs = {}      # ref -> session, for every session the broker knows about
+        self.next_ref = itertools.count(1)
+
+    def serve(self, shard_id, link_socket):
+        self.shard_id = shard_id
+        self.link_socket = link_socket
+        if self.log_sink.path is not None:
+            # One file per worker, rotation needs a single writer
+            self.log_sink.path = f"{self.log_sink.path}.worker{shard_id}"
+        for channel_info in self.channels.values():
+            channel_info['members'] = {}    # username -> shard, every member of the channel
+            channel_info['waiting'] = 0     # queue length across all shards
+        self.start()
+
+    def open_console(self):
+        # Admin commands come from the broker, which owns stdin
+        self.link = Link(self.link_socket, self.selector, (self.handle_link, None))
+
+    def open_scrape_endpoint(self):
+        # The broker serves the scrape socket with every worker's metrics merged
+        pass
+
+    def handle_link(self, link_socket, _, events):
+        if events & selectors.EVENT_WRITE:
+            self.link.flush()
+        if not events & selectors.EVENT_READ:
+            return
+        messages = self.link.receive()
+        if messages is None:
+            # The parent is gone, nobody can admit clients any more
+            self.on_shutdown()
+        for kind, *args in messages:
+            try:
+                getattr(self, 'on_' + kind)(*args)
+            except SystemExit:
+                raise
+            except Exception as e:
+                self.log('error', f"Error in worker {self.shard_id}: {e}")
+            self.reap()
+
+    # Membership changes are requests to the broker, which answers with on_* messages
+
+    def to_home(self, channel_name, *msg):
+        # Sends a request about the channel to whoever owns its membership
+        self.link.send(*msg)
+
+    def register_client(self, session):
+        session.ref = next(self.next_ref)
+        self.refs[session.ref] = session
+        # Held like a queued client until the broker has checked the username
+        session.state = 'queued'
+        self.to_home(session.channel, 'join', session.channel, session.username, session.ref)
+        return True
+
+    def admit_waiting(self, channel_name, notify_from=None):
+        # The broker admits clients as seats free up across all shards
+        pass
+
+    def remove_client(self, session):
+        if session.channel is None:
+            session.state = 'closed'
+            self.registry.remove(session)
+            return
+        channel_info = self.channels[session.channel]
+        if channel_info['clients'].get(session.username) is session:
+            del channel_info['clients'][session.username]
+        elif channel_info['queue'].get(session.username) is session:
+            del channel_info['queue'][session.username]
+        session.state = 'closed'
+        self.timers.cancel(session.afk_timer)
+        session.outbox.clear()
+        self.registry.remove(session)
+        if self.refs.pop(session.ref, None) is not None:
+            self.to_home(session.channel, 'leave', session.channel, session.username, session.ref)
+
+    def switch_channel(self, session, new_channel_name):
+        self.to_home(new_channel_name, 'switch', session.channel, new_channel_name, session.username, session.ref)
+        return session.channel
+
+    def channel_counts(self, channel_name):
+        channel_info = self.channels[channel_name]
+        return len(channel_info['members']), channel_info['capacity'], channel_info['waiting']
+
+    def find_member(self, channel_name, username):
+        channel_info = self.channels[channel_name]
+        session = channel_info['clients'].get(username)
+        if session is None and channel_info['members'].get(username, self.shard_id) != self.shard_id:
+            return RemoteUser(channel_name, username)
+        return session
+
+    def send_to(self, session, data):
+        if isinstance(session, RemoteUser):
+            if isinstance(data, Payload):
+                data = data.data
+            self.to_home(session.channel, 'tell', session.channel, session.username, data)
+        else:
+            super().send_to(session, data)
+
+    def send_file(self, session, target, file_path, upload_path):
+        if isinstance(target, RemoteUser):
+            # The target's worker streams the file, the path is on the same machine
+            self.to_home(session.channel, 'send', session.channel, session.username, target.username, file_path, upload_path)
+        else:
+            super().send_file(session, target, file_path, upload_path)
+
+    def broadcast(self, channel_name, data, exclude=None, history=False):
+        super().broadcast(channel_name, data, exclude, history)
+        self.to_home(channel_name, 'broadcast', channel_name, data, history)
+
+    def local_session(self, channel_name, username):
+        channel_info = self.channels[channel_name]
+        return channel_info['clients'].get(username) or channel_info['queue'].get(username)
+
+    # Messages from the broker
+
+    def on_queued(self, ref):
+        session = self.refs.get(ref)
+        if session is None:
+            return
+        self.channels[session.channel]['queue'][session.username] = session
+        current_time = datetime.now().strftime("%H:%M:%S")
+        welcome_msg = f"[Server message ({current_time}) ] Welcome to the {session.channel} channel, {session.username}."
+        self.send_to(session, welcome_msg.encode('utf-8'))
+
+    def on_rejected(self, ref):
+        session = self.refs.pop(ref, None)
+        if session is None:
+            return
+        current_time = datetime.now().strftime("%H:%M:%S")
+        error_msg = f"[Server message ({current_time}) ] Cannot connect to the {session.channel} channel."
+        self.send_to(session, error_msg.encode('utf-8'))
+        self.close_client(session)
+
+    def on_position(self, ref, queue_position):
+        session = self.refs.get(ref)
+        if session is None:
+            return
+        session.position = queue_position
+        msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] You are in the waiting queue and there are {queue_position} user(s) ahead of you."
+        self.send_to(session, msg.encode('utf-8'))
+
+    def on_admit(self, ref):
+        session = self.refs.get(ref)
+        if session is None or session.state != 'queued':
+            # Already left, its 'leave' is on the way to the broker
+            return
+        channel_info = self.channels[session.channel]
+        if channel_info['queue'].get(session.username) is session:
+            del channel_info['queue'][session.username]
+        channel_info['clients'][session.username] = session
+        session.state = 'active'
+        session.position = None
+        self.replay_history(session)
+        self.on_admitted(session)
+
+    def on_switched(self, ref, new_channel_name, was_member):
+        session = self.refs.get(ref)
+        if session is None:
+            return
+        channel_name, username = session.channel, session.username
+        channel_info = self.channels[channel_name]
+        if channel_info['clients'].get(username) is session:
+            del channel_info['clients'][username]
+        elif channel_info['queue'].get(username) is session:
+            del channel_info['queue'][username]
+        if was_member:
+            leave_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {username} has left the channel."
+            self.log('leave', leave_msg)
+            self.broadcast(channel_name, leave_msg.encode('utf-8'))
+
+        session.channel = new_channel_name
+        session.state = 'queued'
+        session.position = None
+        session.last_active = time.monotonic()
+        self.channels[new_channel_name]['queue'][username] = session
+
+    def on_switch_refused(self, ref, new_channel_name):
+        session = self.refs.get(ref)
+        if session is not None:
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot switch to the {new_channel_name} channel."
+            self.send_to(session, error_msg.encode('utf-8'))
+
+    def on_member(self, channel_name, username, shard):
+        members = self.channels[channel_name]['members']
+        if shard is None:
+            members.pop(username, None)
+        else:
+            members[username] = shard
+
+    def on_waiting(self, channel_name, queue_length):
+        self.channels[channel_name]['waiting'] = queue_length
+
+    def on_deliver(self, channel_name, data, history):
+        # A broadcast from another shard, for the members served here. Every shard keeps
+        # its own copy of the channel history.
+        super().broadcast(channel_name, data, history=history)
+
+    def on_tell(self, channel_name, username, data):
+        session = self.local_session(channel_name, username)
+        if session is not None:
+            self.send_to(session, data)
+
+    def on_send(self, channel_name, username, target_username, file_path, upload_path):
+        target = self.channels[channel_name]['clients'].get(target_username)
+        sender = RemoteUser(channel_name, username)
+        if target is None:
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target_username} is not here."
+            self.send_to(sender, error_msg.encode('utf-8'))
+        else:
+            self.send_file(sender, target, file_path, upload_path)
+
+    def on_command(self, command):
+        # Checked by the broker, which sends it to the shard serving the user, or to every
+        # shard for the profiling commands
+        self.process_server_command(command)
+
+    def on_limit(self, channel_name, limits):
+        self.set_limits(channel_name, limits)
+
+    def on_stats(self, request_id):
+        self.link.send('stats', request_id, self.metrics.snapshot())
+
+    def on_empty(self, channel_name):
+        self.clear_channel(channel_name)
+
+    def on_shutdown(self):
+        for session in self.registry:
+            session.socket.close()
+        self.log_sink.close()
+        sys.exit(0)
+
+
+class FederatedNode(ShardWorker):
+    # One node of a federation, started with --node NAME. The config's node lines home
+    # every channel on one node (see federation.py), whose ChannelHome owns the channel's
+    # members and waiting queue. Every node serves clients of every channel the way a
+    # worker does: membership changes go to the channel's home over a relay link and
+    # broadcasts and whispers come back the same way, so capacity, the queue and /list
+    # hold across the federation. Nodes on one host share the channel ports.
+    reuse_port = True
+
+    def __init__(self, config_file, node_name, **options):
+        super().__init__(config_file, **options)
+        self.shard_id = node_name
+        self.homes = {}     # channel name -> node it is homed on
+        self.home = None    # ChannelHome of the channels homed here
+        self.relay = None
+
+    def load_channels(self):
+        super().load_channels()
+        try:
+            nodes, self.homes = read_nodes(self.config_file, self.channels)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if self.shard_id not in nodes:
+            print(f"Node {self.shard_id} is not in {self.config_file}")
+            sys.exit(1)
+        for channel_info in self.channels.values():
+            channel_info['members'] = {}    # username -> node, every member of the channel
+            channel_info['waiting'] = 0     # queue length across the federation
+        homed_here = {channel_name: channel_info for channel_name, channel_info in self.channels.items()
+                      if self.homes[channel_name] == self.shard_id}
+        self.home = ChannelHome(homed_here, self)
+        self.relay = Relay(self.shard_id, nodes, self)
+
+    def open_console(self):
+        # Every node has a console of its own, for the clients it serves
+        EventLoopChatServer.open_console(self)
+        self.relay.start(self.selector, self.timers)
+
+    def open_scrape_endpoint(self):
+        EventLoopChatServer.open_scrape_endpoint(self)
+
+    def process_server_command(self, command):
+        if command in ("/reload", "/upgrade"):
+            print(f"[Server message ({time.strftime('%H:%M:%S')}) ] {command} is not available on a federated node, restart the node instead.")
+            return
+        super().process_server_command(command)
+
+    # Routing, requests go to the channel's home and its answers to the nodes concerned.
+    # Whatever stays on this node runs once the current event is done, as it would
+    # have had it crossed a link.
+
+    def reachable_nodes(self):
+        return [self.shard_id, *self.relay.links]
+
+    def reachable(self, channel_name):
+        home = self.homes[channel_name]
+        return home == self.shard_id or home in self.relay.links
+
+    def to_home(self, channel_name, kind, *args):
+        home = self.homes[channel_name]
+        if home == self.shard_id:
+            self.call_soon(self.run_local, getattr(self.home, 'on_' + kind), home, *args)
+        else:
+            self.relay.send(home, 'home', kind, *args)
+
+    def to_node(self, node_name, kind, *args):
+        if node_name == self.shard_id:
+            self.call_soon(self.run_local, getattr(self, 'on_' + kind), *args)
+        else:
+            self.relay.send(node_name, kind, *args)
+
+    def run_local(self, handler, *args):
+        handler(*args)
+        # Sessions it closed go before the loop waits again
+        self.reap()
+
+    def on_relay(self, peer, kind, args):
+        try:
+            if kind == 'home' and args and args[0] in HOME_MESSAGES:
+                getattr(self.home, 'on_' + args[0])(peer, *args[1:])
+            elif kind in NODE_MESSAGES:
+                getattr(self, 'on_' + kind)(*args)
+            else:
+                self.log('error', f"Unexpected relay message from node {peer}: {kind}")
+        except Exception as e:
+            self.log('error', f"Error in relay message from node {peer}: {e}")
+        self.reap()
+
+    def on_peer_up(self, peer):
+        self.log('relay', f"[Server message ({time.strftime('%H:%M:%S')}) ] Linked to node {peer}.")
+        # The peer knows nothing yet of the channels homed here
+        for channel_name, channel_info in self.home.channels.items():
+            for username, (node_name, ref) in channel_info['clients'].items():
+                self.relay.send(peer, 'member', channel_name, username, node_name)
+            self.relay.send(peer, 'waiting', channel_name, channel_info['waiting'])
+
+    def on_peer_down(self, peer):
+        self.log('relay', f"[Server message ({time.strftime('%H:%M:%S')}) ] Lost the link to node {peer}.")
+        # Its clients leave the channels homed here, and the channels homed there are
+        # closed to the clients here until it is back
+        self.home.forget(peer)
+        for channel_name, home in self.homes.items():
+            if home == peer:
+                self.channels[channel_name]['members'].clear()
+                self.channels[channel_name]['waiting'] = 0
+        for session in list(self.refs.values()):
+            if self.homes[session.channel] == peer:
+                error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] The {session.channel} channel is unavailable, its node has gone."
+                self.send_to(session, error_msg.encode('utf-8'))
+                self.close_client(session)
+
+    # Clients of channels whose home is down are turned away
+
+    def register_client(self, session):
+        if not self.reachable(session.channel):
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] Cannot connect to the {session.channel} channel."
+            self.send_to(session, error_msg.encode('utf-8'))
+            self.close_client(session)
+            return False
+        return super().register_client(session)
+
+    def switch_channel(self, session, new_channel_name):
+        if not self.reachable(new_channel_name):
+            self.on_switch_refused(session.ref, new_channel_name)
+            return session.channel
+        return super().switch_channel(session, new_channel_name)
+
+    def on_switched(self, ref, new_channel_name, was_member):
+        session = self.refs.get(ref)
+        if session is not None and was_member is None:
+            # The new channel's home does not hold the old one, leave it at its own home
+            channel_info = self.channels[session.channel]
+            was_member = channel_info['clients'].get(session.username) is session
+            self.to_home(session.channel, 'leave', session.channel, session.username, ref)
+        super().on_switched(ref, new_channel_name, was_member)
+
+    def send_file(self, session, target, file_path, upload_path):
+        if isinstance(target, RemoteUser):
+            # The path names a file on this machine, the target's node may be on another
+            error_msg = f"[Server message ({time.strftime('%H:%M:%S')}) ] {target.username} is connected to another node, files can only be sent within a node."
+            self.send_to(session, error_msg.encode('utf-8'))
+            return
+        super().send_file(session, target, file_path, upload_path)
+
+
+class ServerArgumentParser(argparse.ArgumentParser):
+
+    def error(self, message):
+        print(f"{message}")
+        print("Server is properly called with the following format: python3 chatserver.py <configfile> [--mode threaded|eventloop] [--outbox-limit BYTES] [--overflow drop-oldest|disconnect] [--max-file-size BYTES] [--workers N] [--metrics-socket PATH] [--history N] [--history-bytes BYTES] [--replay N] [--log-file PATH] [--log-max-bytes BYTES] [--log-backups N] [--log-fsync SECONDS] [--log-format text|json] [--log-buffer N] [--port PORT] [--backlog N] [--accept-batch N] [--flood-strikes N] [--flood-mute SECONDS] [--profile-dir DIR] [--afk-timeout SECONDS] [--upload-dir DIR] [--node NAME]")
+        sys.exit(1)
+
+
+def serve_sharded(config_file, workers, **options):
+    # The parent process runs the broker and the admin console, every worker an event
+    # loop over its own SO_REUSEPORT listeners. The config is checked before forking.
+    server = ShardWorker(config_file, **options)
     server.load_channels()
+    broker = ShardBroker(server.channels, server.metrics_socket)
+    for shard_id in range(workers):
+        broker_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            broker_end.close()
+            broker.detach()
+            try:
+                server.serve(shard_id, worker_end)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        worker_end.close()
+        broker.add_worker(shard_id, broker_end, pid)
+    broker.run()
+
+
+def main(config_file, mode='threaded', workers=1, takeover=None, node=None, **options):
+    if workers > 1:
+        serve_sharded(config_file, workers, **options)
+        return
+    if node is not None:
+        server = FederatedNode(config_file, node, **options)
+    elif mode == 'eventloop':
+        server = EventLoopChatServer(config_file, **options)
+    else:
+        server = ChatServer(config_file, **options)
+    server.load_channels()
+    if takeover is not None:
+        server.take_over(takeover)
     server.start()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Server is properly called with the following format: python3 chatserver.py <configfile>")
-        sys.exit(1)
-
-    config_file = sys.argv[1]
-    main(config_file)
\ No newline at end of file
+    parser = ServerArgumentParser(add_help=False)
+    parser.add_argument('config_file')
+    # threaded: one thread per channel listener and per client (default)
+    # eventloop: a single selector loop serves every socket
+    parser.add_argument('--mode', choices=['threaded', 'eventloop'], default='threaded')
+    # Bytes that may queue up for one client, and what to do with a client that falls further behind
+    parser.add_argument('--outbox-limit', type=int, default=DEFAULT_LIMIT)
+    parser.add_argument('--overflow', choices=POLICIES, default=DROP_OLDEST)
+    # Largest file /send streams to a client, in bytes
+    parser.add_argument('--max-file-size', type=int, default=DEFAULT_MAX_FILE_SIZE)
+    # Worker processes sharing the channel ports, each an event loop on its own core.
+    # More than one implies eventloop workers coordinated by a broker in this process.
+    parser.add_argument('--workers', type=int, default=1)
+    # Unix socket serving the metrics in Prometheus text format to anything that connects
+    parser.add_argument('--metrics-socket')
+    # Chat messages each channel keeps, by count and by bytes, and how many of them a
+    # client is sent on joining and per /history page
+    parser.add_argument('--history', type=int, default=DEFAULT_HISTORY_SIZE)
+    parser.add_argument('--history-bytes', type=int, default=DEFAULT_HISTORY_BYTES)
+    parser.add_argument('--replay', type=int, default=DEFAULT_REPLAY_COUNT)
+    # Where the log goes (stdout by default), when a log file rotates and how many old ones
+    # are kept, seconds between fsyncs (never by default), the record format, and how
+    # many records may wait for the writer before further ones are dropped
+    parser.add_argument('--log-file')
+    parser.add_argument('--log-max-bytes', type=int, default=DEFAULT_MAX_BYTES)
+    parser.add_argument('--log-backups', type=int, default=DEFAULT_BACKUPS)
+    parser.add_argument('--log-fsync', type=float)
+    parser.add_argument('--log-format', choices=FORMATS, default='text')
+    parser.add_argument('--log-buffer', type=int, default=DEFAULT_BUFFER)
+    # A single port serving every channel, the client names its channel in the handshake.
+    # Channels configured with port 0 are reached through it only.
+    parser.add_argument('--port', type=int)
+    # Listen backlog of every listening socket, and connections accepted per wakeup
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG)
+    parser.add_argument('--accept-batch', type=int, default=DEFAULT_ACCEPT_BATCH)
+    # Messages a client may have rejected by its rate limit in quick succession before it
+    # is muted (0 never mutes), and for how many seconds
+    parser.add_argument('--flood-strikes', type=int, default=DEFAULT_FLOOD_STRIKES)
+    parser.add_argument('--flood-mute', type=int, default=DEFAULT_FLOOD_MUTE)
+    # Where /profile, /memory, /stacks and /timing write their files
+    parser.add_argument('--profile-dir', default='.')
+    # Seconds a member may stay silent before being disconnected as AFK
+    parser.add_argument('--afk-timeout', type=float, default=AFK_TIMEOUT)
+    # Directory /send serves files from, named relative to it. Without it /send is refused.
+    parser.add_argument('--upload-dir')
+    # Serve as node NAME of the federation described by the config's node lines, always
+    # with the eventloop engine
+    parser.add_argument('--node')
+    # Set by /upgrade on the new process: the socket the old one hands its state over on
+    parser.add_argument('--takeover', type=int)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.port is not None and not 0 < args.port < 1024:
+        parser.error("--port must be between 1 and 1023")
+    if args.backlog < 1 or args.accept_batch < 1:
+        parser.error("--backlog and --accept-batch must be at least 1")
+    if args.flood_strikes < 0 or args.flood_mute < 1:
+        parser.error("--flood-strikes must not be negative and --flood-mute must be at least 1")
+    if args.afk_timeout <= 0:
+        parser.error("--afk-timeout must be positive")
+    if args.upload_dir is not None and not os.path.isdir(args.upload_dir):
+        parser.error("--upload-dir must be an existing directory")
+    if args.node is not None and args.workers > 1:
+        parser.error("--node cannot be combined with --workers")
+
+    main(args.config_file, args.mode, args.workers, args.takeover, args.node, outbox_limit=args.outbox_limit, overflow_policy=args.overflow,
+         max_file_size=args.max_file_size, metrics_socket=args.metrics_socket, history_size=args.history,
+         history_bytes=args.history_bytes, replay_count=args.replay, log_file=args.log_file,
+         log_max_bytes=args.log_max_bytes, log_backups=args.log_backups, log_fsync=args.log_fsync,
+         log_format=args.log_format, log_buffer=args.log_buffer, shared_port=args.port, backlog=args.backlog,
+         accept_batch=args.accept_batch, flood_strikes=args.flood_strikes, flood_mute=args.flood_mute,
+         profile_dir=args.profile_dir, afk_timeout=args.afk_timeout, upload_dir=args.upload_dir)
@@ -0,0 +1,229 @@
+import time
+import errno
+import random
+import socket
+import itertools
+import selectors
+from collections import deque
+
+from protocol import MESSAGE, FrameDecoder, ProtocolError, encode_frame, hello
+from outbound import SEND_BUFFERS
+
+
+# Bytes asked for per recv, a burst of chat arrives in a few calls
+RECV_SIZE = 256 * 1024
+
+# Seconds before the first reconnect attempt, doubled after every failed one up to the
+# maximum. Each delay is jittered so that many sessions do not come back in lockstep.
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+
+class ClientSession:
+    # One connection to a chat server. Messages are queued as frames and written as
+    # many at a time as the socket takes, without waiting for replies in between.
+
+    def __init__(self, port, username, channel_name=None, host='127.0.0.1', reconnect=False,
+                 backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.address = (host, port)
+        self.username = username
+        self.channel = channel_name     # only for a server's shared port
+        self.reconnect = reconnect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.socket = None
+        self.decoder = None
+        self.state = 'idle'     # idle -> connecting -> connected -> waiting to reconnect or closed
+        self.frames = deque()   # encoded frames not fully written, the hello first while connecting
+        self.greeting = None    # the hello queued by the current connection
+        self.offset = 0         # bytes of frames[0] already written
+        self.queued = 0         # bytes in frames, the sender's backpressure signal
+        self.attempts = 0       # failed connects since the last message received
+        self.retry_at = None
+        self.quitting = False   # sent /quit, the server hanging up is expected
+        self.ever_connected = False
+
+    def send(self, msg):
+        # Queues a message, str or UTF-8 bytes. Written by the loop's next poll.
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        if msg == b'/quit':
+            self.quitting = True
+        frame = encode_frame(msg)
+        self.frames.append(frame)
+        self.queued += len(frame)
+
+    def closed(self):
+        return self.state == 'closed'
+
+
+class ClientLoop:
+    # Runs any number of ClientSessions from one selector. on_message(session, text) gets
+    # every chat message, on_frame(session, kind, payload) the file transfer frames and
+    # on_close(session, reason) every lost connection, whether it is retried or not.
+
+    def __init__(self, on_message=None, on_frame=None, on_close=None):
+        self.selector = selectors.DefaultSelector()
+        self.sessions = []
+        self.on_message = on_message or (lambda session, text: None)
+        self.on_frame = on_frame or (lambda session, kind, payload: None)
+        self.on_close = on_close or (lambda session, reason: None)
+
+    def add(self, session):
+        self.sessions.append(session)
+        self.connect(session)
+        return session
+
+    def watch(self, fileobj, callback):
+        # Another file to wait on, callback() runs when it is readable
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def unwatch(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def active(self):
+        return any(not session.closed() for session in self.sessions)
+
+    def send(self, session, msg):
+        session.send(msg)
+        if session.state == 'connected':
+            self.flush(session)
+
+    def quit(self, session):
+        # Leaves once everything queued before has been written
+        if session.state != 'closed':
+            self.send(session, '/quit')
+
+    # Connections
+
+    def connect(self, session):
+        session.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        session.socket.setblocking(False)
+        session.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session.decoder = FrameDecoder()
+        session.state = 'connecting'
+        session.retry_at = None
+        # A frame cut off by the last connection is sent again whole
+        session.queued += session.offset
+        session.offset = 0
+        session.greeting = hello(session.username, session.channel)
+        session.frames.appendleft(session.greeting)
+        session.queued += len(session.greeting)
+        self.selector.register(session.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+        error = session.socket.connect_ex(session.address)
+        if error not in (0, errno.EINPROGRESS):
+            self.lost(session, f"Failed to connect: {errno.errorcode.get(error, error)}")
+
+    def connected(self, session):
+        error = session.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.lost(session, f"Failed to connect: {errno.errorcode.get(error, error)}")
+            return False
+        session.state = 'connected'
+        session.ever_connected = True
+        return True
+
+    def lost(self, session, reason):
+        # The connection is gone. Retried after a backoff unless the session asked to leave.
+        self.drop_socket(session)
+        if session.reconnect and not session.quitting:
+            delay = min(session.max_backoff, session.backoff * 2 ** session.attempts)
+            session.attempts += 1
+            session.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            session.state = 'waiting'
+            if session.frames and session.frames[0] is session.greeting:
+                # Never fully sent, connect() queues a new one
+                session.queued -= len(session.frames.popleft()) - session.offset
+                session.offset = 0
+            self.on_close(session, reason)
+        else:
+            self.close(session, reason)
+
+    def close(self, session, reason):
+        self.drop_socket(session)
+        session.state = 'closed'
+        session.frames.clear()
+        session.queued = session.offset = 0
+        self.on_close(session, reason)
+
+    def drop_socket(self, session):
+        if session.socket is None:
+            return
+        self.selector.unregister(session.socket)
+        session.socket.close()
+        session.socket = None
+
+    # I/O
+
+    def poll(self, timeout=None):
+        # Handles whatever is ready, waiting at most timeout seconds (None: until something is)
+        now = time.monotonic()
+        retries = [session.retry_at for session in self.sessions if session.retry_at is not None]
+        if retries:
+            wait = max(0.0, min(retries) - now)
+            timeout = wait if timeout is None else min(timeout, wait)
+        for key, events in self.selector.select(timeout):
+            if not isinstance(key.data, ClientSession):
+                key.data()
+                continue
+            session = key.data
+            if session.state == 'connecting':
+                if not self.connected(session):
+                    continue
+            if events & selectors.EVENT_WRITE and session.socket is not None:
+                self.flush(session)
+            if events & selectors.EVENT_READ and session.socket is not None:
+                self.read(session)
+        now = time.monotonic()
+        for session in self.sessions:
+            if session.retry_at is not None and session.retry_at <= now:
+                self.connect(session)
+
+    def flush(self, session):
+        # Writes as many queued frames as the socket takes in one sendmsg() call
+        frames = session.frames
+        while frames:
+            buffers = list(itertools.islice(frames, SEND_BUFFERS))
+            if session.offset:
+                buffers[0] = memoryview(buffers[0])[session.offset:]
+            try:
+                sent = session.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.lost(session, f"Connection lost: {e}")
+                return
+            session.queued -= sent
+            sent += session.offset
+            while frames and sent >= len(frames[0]):
+                sent -= len(frames.popleft())
+            session.offset = sent
+            if sent:
+                break
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if frames else selectors.EVENT_READ
+        if self.selector.get_key(session.socket).events != events:
+            self.selector.modify(session.socket, events, session)
+
+    def read(self, session):
+        try:
+            data = session.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.lost(session, f"Connection lost: {e}")
+            return
+        if not data:
+            self.lost(session, "Connection closed by the server.")
+            return
+        # The server is talking to us, the next failure starts the backoff over
+        session.attempts = 0
+        try:
+            frames = session.decoder.feed(data)
+        except ProtocolError as e:
+            self.lost(session, f"Protocol error: {e}")
+            return
+        for kind, payload in frames:
+            if kind == MESSAGE:
+                self.on_message(session, payload.decode('utf-8', 'replace'))
+            else:
+                self.on_frame(session, kind, payload)
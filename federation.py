@@ -0,0 +1,221 @@
+import io
+import errno
+import pickle
+import socket
+import selectors
+
+from broker import ChannelDirectory, Link
+
+
+# Seconds between attempts to reach a peer that is down or not started yet
+RELAY_RETRY = 1.0
+
+# What a peer may ask of a node over a relay link. Messages for the directory of the
+# channels homed on the node arrive wrapped as ('home', kind, args...), everything else
+# is the outcome of a request the node made to another channel's home.
+HOME_MESSAGES = frozenset(('join', 'leave', 'switch', 'broadcast', 'tell'))
+NODE_MESSAGES = frozenset(('queued', 'rejected', 'position', 'admit', 'switched', 'switch_refused',
+                           'member', 'waiting', 'deliver', 'tell'))
+
+
+def read_nodes(config_file, channel_names):
+    # Returns (node name -> (host, relay port), channel name -> home node) from the
+    # config's node lines, two empty dicts without any. A line node <name> <host> <port>
+    # [channel ...] lists the channels homed on that node. Raises ValueError with the
+    # message to show.
+    nodes = {}
+    homes = {}
+    with open(config_file, 'r') as f:
+        for line in f:
+            parts = line.strip().split()
+            if not parts or parts[0].lower() != 'node':
+                continue
+            if len(parts) < 4:
+                raise ValueError(f"Invalid node: {' '.join(parts[1:])}")
+            node_name, host = parts[1], parts[2]
+            try:
+                relay_port = int(parts[3])
+                if not 0 < relay_port < 1024:
+                    raise ValueError
+            except ValueError:
+                raise ValueError(f"Invalid relay port: {parts[3]}")
+            if node_name in nodes:
+                raise ValueError(f"Duplicate node name: {node_name}")
+            if (host, relay_port) in nodes.values():
+                raise ValueError(f"Duplicate relay port: {relay_port}")
+            for channel_name in parts[4:]:
+                if channel_name not in channel_names:
+                    raise ValueError(f"Node {node_name} is home to unknown channel: {channel_name}")
+                if channel_name in homes:
+                    raise ValueError(f"Channel {channel_name} is homed on both {homes[channel_name]} and {node_name}")
+                homes[channel_name] = node_name
+            nodes[node_name] = (host, relay_port)
+
+    if nodes:
+        for channel_name in channel_names:
+            if channel_name not in homes:
+                raise ValueError(f"Channel {channel_name} has no home node")
+    return nodes, homes
+
+
+class PlainUnpickler(pickle.Unpickler):
+    # Relay links come from the network. Their messages hold plain values only and
+    # may never name a class or function to be loaded.
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed on a relay link")
+
+
+def relay_loads(data):
+    return PlainUnpickler(io.BytesIO(data)).load()
+
+
+class ChannelHome(ChannelDirectory):
+    # The directory of the channels homed on one node of a federation. Its shards are
+    # the nodes, this one included: every node serving clients of these channels asks
+    # here to admit them and is told the outcome, the way workers ask the broker.
+
+    def __init__(self, channels, node):
+        super().__init__(channels)
+        self.node = node    # the FederatedNode, which routes messages to the other nodes
+
+    def send(self, node_name, *msg):
+        self.node.to_node(node_name, *msg)
+
+    def send_all(self, *msg, skip=None):
+        for node_name in self.node.reachable_nodes():
+            if node_name != skip:
+                self.node.to_node(node_name, *msg)
+
+
+class Relay:
+    # The TCP links from one node to every other node of the federation, one link per
+    # pair. Of each pair the node whose name sorts first dials, and dials again every
+    # RELAY_RETRY seconds while the link is down; the other one accepts. A dialled
+    # link's first message is ('hello', node name). The node is told with
+    # on_peer_up(name), on_relay(name, kind, args) and on_peer_down(name).
+
+    def __init__(self, node_name, nodes, node):
+        self.name = node_name
+        self.nodes = nodes      # node name -> (host, relay port), this one included
+        self.node = node
+        self.selector = None
+        self.timers = None
+        self.listener = None
+        self.links = {}         # node name -> Link, for every peer connected
+        self.accepted = {}      # socket -> Link, until its hello names the peer
+
+    def start(self, selector, timers):
+        self.selector = selector
+        self.timers = timers
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.nodes[self.name])
+        self.listener.listen()
+        self.listener.setblocking(False)
+        selector.register(self.listener, selectors.EVENT_READ, (self.accept, None))
+        print(f"Node '{self.name}' relaying on port {self.nodes[self.name][1]}")
+        for peer in self.nodes:
+            if peer > self.name:
+                self.dial(peer)
+
+    def dial(self, peer):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex(self.nodes[peer])
+        if error not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.timers.schedule(RELAY_RETRY, self.dial, peer)
+            return
+        self.selector.register(sock, selectors.EVENT_WRITE, (self.dialled, peer))
+
+    def dialled(self, sock, peer, events):
+        self.selector.unregister(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            sock.close()
+            self.timers.schedule(RELAY_RETRY, self.dial, peer)
+            return
+        self.attach(peer, self.open_link(sock, peer))
+        self.send(peer, 'hello', self.name)
+        self.node.on_peer_up(peer)
+
+    def accept(self, listener, _, events):
+        try:
+            sock, addr = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.accepted[sock] = self.open_link(sock, None)
+
+    def open_link(self, sock, peer):
+        # Broadcasts cross the link as soon as they are sent, like chat to a client
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return Link(sock, self.selector, (self.handle_link, peer), relay_loads)
+
+    def attach(self, peer, link):
+        if peer in self.links:
+            # Restarted before its old link was seen to close
+            self.lose(peer)
+        self.links[peer] = link
+        link.data = (self.handle_link, peer)
+        self.selector.modify(link.socket, link.events, link.data)
+
+    def greet(self, link, kind, args):
+        # The first message of an accepted link, returns the peer it names or None
+        # once the link has been closed
+        del self.accepted[link.socket]
+        if kind != 'hello' or len(args) != 1 or not isinstance(args[0], str) or args[0] not in self.nodes or args[0] >= self.name:
+            link.close()
+            return None
+        peer = args[0]
+        self.attach(peer, link)
+        self.node.on_peer_up(peer)
+        return peer
+
+    def handle_link(self, sock, peer, events):
+        link = self.links[peer] if peer is not None else self.accepted[sock]
+        try:
+            if events & selectors.EVENT_WRITE:
+                link.flush()
+            messages = link.receive() if events & selectors.EVENT_READ else []
+        except Exception as e:
+            # Reset, or a frame that is not a relay message
+            self.node.log('error', f"Relay link to {peer or 'a new peer'} failed: {e}")
+            messages = None
+        if messages is None:
+            if peer is None:
+                del self.accepted[sock]
+                link.close()
+            else:
+                self.lose(peer)
+            return
+        for kind, *args in messages:
+            if peer is None:
+                peer = self.greet(link, kind, args)
+                if peer is None:
+                    return
+                continue
+            if self.links.get(peer) is not link:
+                # Lost while handling an earlier message
+                return
+            self.node.on_relay(peer, kind, args)
+
+    def send(self, peer, *msg):
+        # Returns False if the peer is not connected, the message is dropped then
+        link = self.links.get(peer)
+        if link is None:
+            return False
+        try:
+            link.send(*msg)
+        except OSError:
+            # Reset, or not draining. Shut down so the next select reports it closed.
+            try:
+                link.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return True
+
+    def lose(self, peer):
+        self.links.pop(peer).close()
+        self.node.on_peer_down(peer)
+        if peer > self.name:
+            self.timers.schedule(RELAY_RETRY, self.dial, peer)
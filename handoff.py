@@ -0,0 +1,67 @@
+import sys
+import pickle
+import socket
+import struct
+import subprocess
+
+
+# File descriptors per SCM_RIGHTS message, the kernel accepts at most 253
+FDS_PER_MESSAGE = 250
+
+# First message of a handoff: how many descriptors follow and the length of the state
+HANDOFF_HEADER = struct.Struct('!IQ')
+
+# Seconds the old process waits for the new one to take over before carrying on itself
+TAKEOVER_TIMEOUT = 10
+
+
+def spawn_successor(link):
+    # Starts the new server with the same command line plus --takeover, inheriting the
+    # console. link is the new process's end of the handoff socket pair.
+    argv = list(sys.argv)
+    if '--takeover' in argv:
+        # Left over from an earlier upgrade
+        i = argv.index('--takeover')
+        del argv[i:i + 2]
+    fd = link.fileno()
+    return subprocess.Popen([sys.executable] + argv + ['--takeover', str(fd)], pass_fds=[fd])
+
+
+def send_state(sock, state, fds):
+    # The state is pickled and refers to sockets and files by their index in fds
+    data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    socket.send_fds(sock, [HANDOFF_HEADER.pack(len(fds), len(data))], fds[:FDS_PER_MESSAGE])
+    for start in range(FDS_PER_MESSAGE, len(fds), FDS_PER_MESSAGE):
+        socket.send_fds(sock, [b'F'], fds[start:start + FDS_PER_MESSAGE])
+    sock.sendall(data)
+
+
+def receive_state(sock):
+    header, fds = receive_with_fds(sock, HANDOFF_HEADER.size)
+    count, length = HANDOFF_HEADER.unpack(header)
+    while len(fds) < count:
+        _, more = receive_with_fds(sock, 1)
+        fds.extend(more)
+    return pickle.loads(receive_exactly(sock, length)), fds
+
+
+def receive_with_fds(sock, size):
+    # The descriptors arrive with the first byte of the message they were sent with
+    data, fds = b'', []
+    while len(data) < size:
+        chunk, more, _, _ = socket.recv_fds(sock, size - len(data), FDS_PER_MESSAGE)
+        if not chunk:
+            raise ConnectionError("handoff socket closed")
+        data += chunk
+        fds.extend(more)
+    return data, fds
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("handoff socket closed")
+        data += chunk
+    return bytes(data)
@@ -0,0 +1,48 @@
+import itertools
+from collections import deque
+
+from protocol import HEADER
+
+
+# Messages each channel keeps for replay, bounded by count and by bytes
+DEFAULT_HISTORY_SIZE = 200
+DEFAULT_HISTORY_BYTES = 256 * 1024
+
+# Messages sent to a client when it is admitted, and per /history page
+DEFAULT_REPLAY_COUNT = 20
+
+
+class History:
+    # Ring buffer of the most recent chat messages of one channel. Entries are the
+    # Payloads of the live broadcasts, framed already, so a replay is one joined write.
+    # Every message gets a sequence number for paging further back with /history.
+
+    def __init__(self, max_messages=DEFAULT_HISTORY_SIZE, max_bytes=DEFAULT_HISTORY_BYTES):
+        self.entries = deque()
+        self.size = 0           # bytes held, raw and framed copies together
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.next_seq = 0       # sequence number of the next message recorded
+
+    def append(self, payload):
+        # Frames the payload now if the broadcast has not already
+        payload.framed()
+        self.entries.append(payload)
+        self.size += entry_size(payload)
+        self.next_seq += 1
+        while self.entries and (len(self.entries) > self.max_messages or self.size > self.max_bytes):
+            self.size -= entry_size(self.entries.popleft())
+
+    def page(self, before, count):
+        # Up to count messages recorded before sequence number before, oldest first,
+        # and the sequence number of the first one
+        first_seq = self.next_seq - len(self.entries)
+        end = min(before, self.next_seq) - first_seq
+        if end <= 0:
+            return [], before
+        start = max(0, end - count)
+        return list(itertools.islice(self.entries, start, end)), first_seq + start
+
+
+def entry_size(payload):
+    return 2 * len(payload.data) + HEADER.size
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+
+
+# Records that may wait for the writer, further ones are dropped and counted
+DEFAULT_BUFFER = 10000
+
+# A log file is rotated once it reaches this size, keeping this many old files
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+
+FORMATS = ('text', 'json')
+
+
+class LogSink:
+    # Server log. Producers append a record to a bounded queue and never wait on I/O;
+    # a writer thread formats whatever has piled up and writes it as one batch to
+    # stdout or to a rotating file, fsyncing at most every fsync_interval seconds.
+
+    def __init__(self, metrics, path=None, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS,
+                 fsync_interval=None, log_format='text', buffer=DEFAULT_BUFFER):
+        self.metrics = metrics
+        self.path = path        # None writes to stdout
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.fsync_interval = fsync_interval
+        self.log_format = log_format
+        self.buffer = buffer
+        self.records = deque()  # (time, event, text)
+        self.wake = threading.Event()
+        self.closing = False
+        self.thread = None
+        self.file = None
+        self.size = 0
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def log(self, event, text):
+        if len(self.records) >= self.buffer:
+            self.metrics.count('log_dropped')
+            return
+        self.records.append((time.time(), event, text))
+        if not self.wake.is_set():
+            self.wake.set()
+
+    def start(self):
+        if self.path is not None:
+            self.open_file()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        # Writes out what is queued, for shutdown
+        if self.thread is None:
+            return
+        self.closing = True
+        self.wake.set()
+        self.thread.join(5)
+
+    def run(self):
+        while not self.closing:
+            self.wake.wait(self.fsync_interval if self.unsynced else None)
+            self.wake.clear()
+            try:
+                self.write_batch()
+            except OSError as e:
+                # The log must never take the server down
+                print(f"Error writing log: {e}", file=sys.stderr)
+        self.write_batch()
+        self.sync()
+
+    def write_batch(self):
+        # Only the records queued so far; producers keep appending behind them
+        batch = [self.records.popleft() for _ in range(len(self.records))]
+        if batch:
+            text = ''.join(map(self.format, batch))
+            if self.file is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                data = text.encode('utf-8')
+                self.file.write(data)
+                self.file.flush()
+                self.size += len(data)
+                self.unsynced = True
+                if self.size >= self.max_bytes:
+                    self.rotate()
+        if self.unsynced and self.fsync_interval is not None and time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def format(self, record):
+        stamp, event, text = record
+        if self.log_format == 'json':
+            return json.dumps({'time': round(stamp, 3), 'event': event, 'message': text}) + '\n'
+        return text + '\n'
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def open_file(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        # path -> path.1 -> path.2 ..., the oldest is removed
+        self.sync()
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open_file()
@@ -0,0 +1,215 @@
+import os
+import time
+import socket
+import threading
+
+
+# Histogram bucket i counts values below 2**i microseconds, the last one everything
+# slower. One extra slot after the buckets holds the sum in microseconds.
+BUCKETS = 40
+
+# Shards of finished threads are folded in once the list has doubled since the last time,
+# so clients coming and going never grow it without bound between two reads
+MIN_PRUNE = 64
+
+
+class Shard:
+    # The counters and histograms written by one thread
+
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}      # (name, channel) -> count
+        self.histograms = {}    # (name, channel) -> bucket counts + sum
+
+
+class Metrics:
+    # Counters and latency histograms. Every thread writes to its own shard without
+    # taking a lock; reads merge the shards and fold in those of finished threads.
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.retired = Shard(None)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.prune_at = MIN_PRUNE
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard(threading.current_thread())
+            with self.lock:
+                self.shards.append(shard)
+                if len(self.shards) >= self.prune_at:
+                    self.retire_finished()
+                    self.prune_at = max(MIN_PRUNE, 2 * len(self.shards))
+            return shard
+
+    def retire_finished(self):
+        # Under the lock. Nothing writes to a finished thread's shard any more.
+        live = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                merge_shard(self.retired, shard.counters, shard.histograms)
+        self.shards = live
+
+    def count(self, name, channel=None, value=1):
+        counters = self.shard().counters
+        key = (name, channel)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, channel=None):
+        histograms = self.shard().histograms
+        key = (name, channel)
+        buckets = histograms.get(key)
+        if buckets is None:
+            buckets = histograms[key] = [0] * (BUCKETS + 1)
+        micros = int(seconds * 1e6)
+        buckets[min(micros.bit_length(), BUCKETS - 1)] += 1
+        buckets[BUCKETS] += micros
+
+    def snapshot(self):
+        # Plain dicts and lists, so a snapshot can be pickled to the broker.
+        # Copying a dict or list is a single step under the GIL, the writer never blocks.
+        snapshot = {'counters': {}, 'histograms': {}, 'uptime': time.monotonic() - self.started}
+        with self.lock:
+            self.retire_finished()
+            for shard in [self.retired] + self.shards:
+                merge_shard(snapshot, dict(shard.counters), {key: list(buckets) for key, buckets in dict(shard.histograms).items()})
+        return snapshot
+
+
+def merge_shard(into, counters, histograms):
+    # into is a Shard or a snapshot dict
+    total_counters = into['counters'] if isinstance(into, dict) else into.counters
+    total_histograms = into['histograms'] if isinstance(into, dict) else into.histograms
+    for key, value in counters.items():
+        total_counters[key] = total_counters.get(key, 0) + value
+    for key, buckets in histograms.items():
+        total = total_histograms.get(key)
+        if total is None:
+            total_histograms[key] = list(buckets)
+        else:
+            for i, value in enumerate(buckets):
+                total[i] += value
+
+
+def merge_snapshots(into, snapshot):
+    merge_shard(into, snapshot['counters'], snapshot['histograms'])
+    into['uptime'] = max(into['uptime'], snapshot['uptime'])
+
+
+class TimedLock:
+    # A channel lock that records in the lock_wait histogram how long contended
+    # acquisitions waited. Uncontended ones cost one extra non-blocking attempt.
+
+    __slots__ = ('lock', 'metrics', 'channel')
+
+    def __init__(self, metrics, channel_name):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.channel = channel_name
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            started = time.perf_counter()
+            self.lock.acquire()
+            self.metrics.observe('lock_wait', time.perf_counter() - started, self.channel)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def percentile(buckets, q):
+    # Upper bound of the bucket holding the q-th value, in milliseconds
+    total = sum(buckets[:BUCKETS])
+    if not total:
+        return 0.0
+    seen = 0
+    for i in range(BUCKETS):
+        seen += buckets[i]
+        if seen >= q * total:
+            return 2 ** i / 1000
+    return 2 ** BUCKETS / 1000
+
+
+def format_histogram(buckets):
+    count = sum(buckets[:BUCKETS])
+    mean = buckets[BUCKETS] / count / 1000 if count else 0.0
+    return f"n={count} mean={mean:.3f}ms p50<{percentile(buckets, 0.5):g}ms p99<{percentile(buckets, 0.99):g}ms"
+
+
+def render_stats(snapshot, gauges, sizes=None):
+    # Lines for the /stats admin command. gauges maps channel -> (members, capacity, queued),
+    # sizes structure name -> entries.
+    counters, histograms = snapshot['counters'], snapshot['histograms']
+    lines = [f"[ Stats ] uptime {snapshot['uptime']:.0f}s"]
+    for channel_name, (members, capacity, queued) in gauges.items():
+        counts = ' '.join(f"{name} {counters.get((name, channel_name), 0)}"
+                          for name in ('messages_in', 'bytes_in', 'messages_out', 'bytes_out', 'rate_limited', 'queued_dropped'))
+        lines.append(f"[ Stats ] {channel_name} active {members}/{capacity} queued {queued} {counts}")
+        for name in ('queue_wait', 'fanout', 'lock_wait'):
+            if (name, channel_name) in histograms:
+                lines.append(f"[ Stats ] {channel_name} {name} {format_histogram(histograms[(name, channel_name)])}")
+    totals = ' '.join(f"{name} {value}" for (name, channel_name), value in sorted(counters.items(), key=str) if channel_name is None)
+    if totals:
+        lines.append(f"[ Stats ] server {totals}")
+    if sizes:
+        lines.append(f"[ Stats ] sizes {' '.join(f'{name} {size}' for name, size in sizes.items())}")
+    return lines
+
+
+def render_prometheus(snapshot, gauges, sizes=None):
+    # Text exposition format, served on the scrape socket
+    lines = [f"chat_uptime_seconds {snapshot['uptime']:.3f}"]
+    for name, size in (sizes or {}).items():
+        lines.append(f'chat_structure_size{{structure="{name}"}} {size}')
+    for channel_name, (members, capacity, queued) in gauges.items():
+        lines.append(f'chat_active_clients{{channel="{channel_name}"}} {members}')
+        lines.append(f'chat_capacity{{channel="{channel_name}"}} {capacity}')
+        lines.append(f'chat_queued_clients{{channel="{channel_name}"}} {queued}')
+    for (name, channel_name), value in sorted(snapshot['counters'].items(), key=str):
+        labels = f'{{channel="{channel_name}"}}' if channel_name else ''
+        lines.append(f"chat_{name}_total{labels} {value}")
+    for (name, channel_name), buckets in sorted(snapshot['histograms'].items(), key=str):
+        channel_label = f'channel="{channel_name}"' if channel_name else ''
+        labels = f'{{{channel_label}}}' if channel_label else ''
+        prefix = channel_label + ',' if channel_label else ''
+        seen = 0
+        for i in range(BUCKETS):
+            # Empty buckets are left out, the counts are cumulative anyway
+            seen += buckets[i]
+            if buckets[i]:
+                lines.append(f'chat_{name}_seconds_bucket{{{prefix}le="{2 ** i / 1e6:g}"}} {seen}')
+        lines.append(f'chat_{name}_seconds_bucket{{{prefix}le="+Inf"}} {seen}')
+        lines.append(f'chat_{name}_seconds_sum{labels} {buckets[BUCKETS] / 1e6:g}')
+        lines.append(f'chat_{name}_seconds_count{labels} {seen}')
+    return '\n'.join(lines) + '\n'
+
+
+def open_scrape_socket(path):
+    # A unix socket on the local machine, replacing one left behind by an earlier run
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    return listener
+
+
+def serve_scrapes(listener, collect):
+    # Thread body: every connection gets one rendering of collect() and is closed
+    while True:
+        conn, _ = listener.accept()
+        try:
+            conn.sendall(collect().encode('utf-8'))
+        except OSError:
+            pass
+        finally:
+            conn.close()
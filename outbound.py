@@ -0,0 +1,224 @@
+import socket
+import selectors
+import itertools
+import threading
+from collections import deque
+
+from timers import TimerWheel
+
+
+# What happens when a client's outbound queue is full
+DROP_OLDEST = 'drop-oldest'   # discard the oldest queued messages to make room
+DISCONNECT = 'disconnect'     # hang up on the slow client
+POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# Bytes that may wait for one client before the overflow policy kicks in
+DEFAULT_LIMIT = 256 * 1024
+
+# File frames written per write() call, so one fast reader of a big file cannot
+# keep the writing thread or the event loop to itself
+FILE_FRAMES_PER_WRITE = 4
+
+# Queued messages handed to the kernel in one sendmsg() call, well below IOV_MAX
+SEND_BUFFERS = 512
+
+# Granularity of batched delivery, output held back for a channel's flush interval
+# goes out at most this much later
+FLUSH_RESOLUTION = 0.001
+
+# A batch this big is written without waiting out the flush interval, so a busy
+# channel cannot push a client that keeps up into the outbox limit
+BATCH_BYTES = 64 * 1024
+
+
+class OutboundQueue:
+    # Encoded messages waiting to be written to one client socket
+
+    __slots__ = ('chunks', 'size', 'offset', 'limit', 'policy', 'dropped', 'transfers', 'held', 'lock')
+
+    def __init__(self, limit=DEFAULT_LIMIT, policy=DROP_OLDEST):
+        self.chunks = deque()
+        self.size = 0           # unsent bytes across all chunks
+        self.offset = 0         # bytes of chunks[0] already written
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0        # messages discarded by DROP_OLDEST
+        self.transfers = deque()    # file transfers, framed lazily once the chunks are out
+        self.held = False       # batched delivery: waiting for the flush interval to pass
+        self.lock = threading.Lock()
+
+    def idle(self):
+        return not self.chunks and not self.transfers
+
+    def batch_full(self):
+        return self.held and self.size >= min(BATCH_BYTES, self.limit // 2)
+
+    def push(self, data):
+        # Returns False when the queue is full and the policy says to disconnect
+        if self.size + len(data) > self.limit:
+            if self.policy == DISCONNECT:
+                return False
+            # A partly written message has to go out whole or the stream is corrupted,
+            # and a file frame (always the head) is part of a transfer
+            head = self.chunks.popleft() if self.offset or self.chunks and not isinstance(self.chunks[0], bytes) else None
+            while self.chunks and self.size + len(data) > self.limit:
+                self.size -= len(self.chunks.popleft())
+                self.dropped += 1
+            if head is not None:
+                self.chunks.appendleft(head)
+        self.chunks.append(data)
+        self.size += len(data)
+        return True
+
+    def write(self, sock):
+        # Writes as much as the socket takes without blocking, True once empty.
+        # Socket errors other than a full buffer are left to the caller.
+        self.held = False
+        file_frames = 0
+        while True:
+            if not self.chunks:
+                # Messages always go first, a transfer only gets the socket when they are out
+                if not self.transfers:
+                    return True
+                if file_frames == FILE_FRAMES_PER_WRITE:
+                    return False
+                frame = self.transfers[0].next_frame()
+                if frame is None:
+                    self.transfers.popleft()
+                    continue
+                if isinstance(frame, bytes):
+                    self.size += len(frame)
+                else:
+                    file_frames += 1
+                self.chunks.append(frame)
+            head = self.chunks[0]
+            if not isinstance(head, bytes):
+                if not head.write(sock):
+                    return False
+                self.chunks.popleft()
+                continue
+            # Every message queued ahead of the next file frame, gathered into one call
+            buffers = [memoryview(head)[self.offset:]]
+            for chunk in itertools.islice(self.chunks, 1, SEND_BUFFERS):
+                if not isinstance(chunk, bytes):
+                    break
+                buffers.append(chunk)
+            try:
+                sent = sock.sendmsg(buffers, (), socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            sent += self.offset
+            self.offset = 0
+            for _ in range(len(buffers)):
+                if sent < len(self.chunks[0]):
+                    self.offset = sent
+                    return False
+                sent -= len(self.chunks.popleft())
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+        self.offset = 0
+        while self.transfers:
+            self.transfers.popleft().abort()
+
+
+class OutboundWriter:
+    # One thread that finishes writes the sending threads could not complete without
+    # blocking, so a client with a full TCP window never holds up anyone else
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.pending = []
+        self.calls = []     # callbacks to run on this thread, outside any outbox lock
+        self.lock = threading.Lock()
+        self.timers = TimerWheel(FLUSH_RESOLUTION)  # batched writes waiting for their flush
+
+    def start(self):
+        writer_thread = threading.Thread(target=self.run)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def want_write(self, sock, outbox):
+        with self.lock:
+            self.pending.append((sock, outbox))
+        self.wake()
+
+    def write_later(self, sock, outbox, delay):
+        # Batched delivery: whatever the outbox gathers in the next delay seconds is
+        # written in one go. The writer only needs waking if it was not timing anything.
+        idle = not self.timers.pending
+        self.timers.schedule(delay, self.register, sock, outbox)
+        if idle:
+            self.wake()
+
+    def call_soon(self, callback, *args):
+        with self.lock:
+            self.calls.append((callback, args))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # Already plenty of wakeups queued
+            pass
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select(self.timers.timeout()):
+                if key.fileobj is self.wakeup_recv:
+                    self.register_pending()
+                else:
+                    self.write(key.fileobj, key.data)
+            self.timers.expire()
+            self.run_calls()
+
+    def run_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, []
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error in writer callback: {e}")
+
+    def register_pending(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for sock, outbox in pending:
+            self.register(sock, outbox)
+
+    def register(self, sock, outbox):
+        # Writes once the socket is writable, which a batch usually is right away
+        fd = sock.fileno()
+        if fd == -1:
+            return
+        stale = self.selector.get_map().get(fd)
+        if stale is not None:
+            if stale.fileobj is sock:
+                return
+            # The fd was closed and handed out again to a new socket
+            self.selector.unregister(stale.fileobj)
+        self.selector.register(sock, selectors.EVENT_WRITE, outbox)
+
+    def write(self, sock, outbox):
+        with outbox.lock:
+            try:
+                drained = outbox.write(sock)
+            except OSError:
+                # Peer is gone, the thread reading the socket cleans up
+                outbox.clear()
+                drained = True
+        if drained:
+            self.selector.unregister(sock)
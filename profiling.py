@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import threading
+import traceback
+import tracemalloc
+from collections import Counter
+
+
+# Seconds between two samples of every thread's stack
+SAMPLE_INTERVAL = 0.01
+
+# Allocation sites listed in a tracemalloc diff
+MEMORY_TOP = 50
+
+# Histogram name prefix of the per-command timings in the metrics
+COMMAND_METRIC = 'command_'
+
+
+def command_name(msg):
+    # What a client message is timed as
+    if msg.startswith('/'):
+        name = msg.split(' ', 1)[0][1:]
+        if name in ('list', 'history', 'switch', 'send', 'whisper', 'quit'):
+            return name
+    return 'broadcast'
+
+
+class Profiler:
+    # Diagnostics started and stopped from the admin console. Nothing here runs and
+    # nothing is traced until a command asks for it. Every command writes its own file.
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.samples = None     # (thread name, code objects outermost first) -> count
+        self.sampler = None
+        self.sample_count = 0
+        self.memory_baseline = None
+
+    def output_path(self, kind, suffix):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, f"{kind}-{os.getpid()}-{stamp}.{suffix}")
+
+    # Sampling profiler: covers every thread of the threaded engine, which a cProfile
+    # session enabled from the console thread would not
+
+    def start_sampling(self, interval=SAMPLE_INTERVAL):
+        # False if a session is already running
+        if self.sampler is not None:
+            return False
+        self.samples = Counter()
+        self.sample_count = 0
+        self.sampler = threading.Thread(target=self.sample, args=(interval,), name='profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+        return True
+
+    def stop_sampling(self):
+        # Writes the samples in collapsed stack format, as flamegraph.pl and speedscope
+        # read it, and returns the path. None if no session was running.
+        sampler, self.sampler = self.sampler, None
+        if sampler is None:
+            return None
+        sampler.join()
+        path = self.output_path('profile', 'folded')
+        with open(path, 'w') as output:
+            for (thread_name, codes), count in self.samples.most_common():
+                frames = ';'.join(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})" for code in codes)
+                output.write(f"{thread_name};{frames} {count}\n")
+        self.samples = None
+        return path
+
+    def sample(self, interval):
+        me = threading.get_ident()
+        names = {}
+        while self.sampler is not None:
+            time.sleep(interval)
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                self.samples[names.get(ident, str(ident)), tuple(reversed(codes))] += 1
+            self.sample_count += 1
+
+    # tracemalloc: tracing slows every allocation down, so it only runs between the
+    # first /memory and /memory stop
+
+    def memory_diff(self):
+        # Starts tracing on the first call. Later calls write the allocation sites that grew
+        # the most since the previous call and return the path.
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.memory_baseline = tracemalloc.take_snapshot()
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.memory_baseline, 'lineno')
+        self.memory_baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        path = self.output_path('memory', 'txt')
+        with open(path, 'w') as output:
+            output.write(f"# traced {current} bytes, peak {peak} bytes\n")
+            for stat in stats[:MEMORY_TOP]:
+                output.write(f"{stat}\n")
+        return path
+
+    def stop_memory(self):
+        tracing = tracemalloc.is_tracing()
+        tracemalloc.stop()
+        self.memory_baseline = None
+        return tracing
+
+    def dump_stacks(self):
+        # Every thread's current stack, in the format of a traceback
+        path = self.output_path('stacks', 'txt')
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(path, 'w') as output:
+            for ident, frame in sys._current_frames().items():
+                output.write(f"Thread {names.get(ident, '?')} ({ident}), most recent call last:\n")
+                output.write(''.join(traceback.format_stack(frame)))
+                output.write('\n')
+        return path
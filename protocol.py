@@ -0,0 +1,134 @@
+import struct
+
+
+# Sent by framed clients before their first frame. A legacy client sends its
+# username as the very first bytes, which can never start with a NUL byte.
+MAGIC = b'\x00CHAT/2\n'
+
+# Every frame is a 4 byte big-endian payload length, a 1 byte kind, then the payload
+HEADER = struct.Struct('!IB')
+
+# Frame kinds
+MESSAGE = 0
+FILE_START = 1      # transfer id, file size, then the file name
+FILE_CHUNK = 2      # transfer id, then a slice of the file
+FILE_END = 3        # transfer id
+
+# Prefix of every file frame payload. Transfer ids keep several transfers to the
+# same client apart, since their chunks interleave with each other and with chat.
+FILE_START_HEADER = struct.Struct('!IQ')
+FILE_HEADER = struct.Struct('!I')
+
+# Largest payload either side accepts, anything bigger is a protocol error
+MAX_FRAME_SIZE = 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(payload, kind=MESSAGE):
+    return HEADER.pack(len(payload), kind) + payload
+
+
+class Payload:
+    # One outgoing message. Broadcasts build it once and every recipient's codec
+    # reuses the same encoded bytes, so framing happens once per broadcast.
+
+    __slots__ = ('data', '_framed')
+
+    def __init__(self, data):
+        self.data = data
+        self._framed = None
+
+    def framed(self):
+        if self._framed is None:
+            self._framed = encode_frame(self.data)
+        return self._framed
+
+
+class FrameDecoder:
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        # Returns every complete (kind, payload) frame now in the buffer. The consumed
+        # prefix is cut off once per call, not once per frame.
+        self.buffer += data
+        frames = []
+        view = memoryview(self.buffer)
+        offset = 0
+        end = len(self.buffer)
+        while end - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(view, offset)
+            if length > self.max_frame_size:
+                view.release()
+                raise ProtocolError(f"frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+            if end - offset - HEADER.size < length:
+                break
+            start = offset + HEADER.size
+            frames.append((kind, bytes(view[start:start + length])))
+            offset = start + length
+        view.release()
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class FramedCodec:
+    framed = True
+    recv_size = 65536
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+
+    def feed(self, data):
+        return [payload.decode('utf-8', 'replace') for kind, payload in self.decoder.feed(data) if kind == MESSAGE]
+
+    def encode(self, data):
+        if isinstance(data, Payload):
+            return data.framed()
+        return encode_frame(data)
+
+    def encode_many(self, payloads):
+        return b''.join(payload.framed() for payload in payloads)
+
+
+class RawCodec:
+    # Legacy clients: every recv() is one message and nothing is framed
+    framed = False
+    recv_size = 1024
+
+    def feed(self, data):
+        return [data.decode('utf-8', 'replace')]
+
+    def encode(self, data):
+        if isinstance(data, Payload):
+            return data.data
+        return data
+
+    def encode_many(self, payloads):
+        # Nothing marks where one message ends, a newline is the best there is
+        return b'\n'.join(payload.data for payload in payloads)
+
+
+def negotiate(data):
+    # Works out from the first bytes a client sent which protocol it speaks.
+    # Returns (codec, messages), or (None, []) until there are enough bytes to tell.
+    if data.startswith(MAGIC):
+        codec = FramedCodec()
+        return codec, codec.feed(data[len(MAGIC):])
+    if MAGIC.startswith(data):
+        return None, []
+    codec = RawCodec()
+    return codec, codec.feed(data)
+
+
+def hello(username, channel_name=None):
+    # What a framed client sends right after connecting. On a server's shared port the
+    # username is preceded by the channel to join.
+    if channel_name is not None:
+        username = f"{channel_name} {username}"
+    return MAGIC + encode_frame(username.encode('utf-8'))
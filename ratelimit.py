@@ -0,0 +1,81 @@
+import time
+
+
+# (user messages/s, user bytes/s, channel messages/s, channel bytes/s), 0 is no limit
+NO_LIMITS = (0, 0, 0, 0)
+
+# A client whose messages are rejected this many times within about FLOOD_WINDOW
+# seconds is muted for DEFAULT_FLOOD_MUTE seconds
+DEFAULT_FLOOD_STRIKES = 5
+DEFAULT_FLOOD_MUTE = 30
+FLOOD_WINDOW = 10
+
+
+class TokenBucket:
+    # Holds up to burst tokens, refilled at rate per second. The refill is worked out
+    # from the time since the last call, so an idle bucket costs nothing.
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def ready(self, amount, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        # Anything bigger than the whole bucket passes when it is full and leaves it in debt
+        return self.tokens >= min(amount, self.burst)
+
+    def take(self, amount, now):
+        if not self.ready(amount, now):
+            return False
+        self.tokens -= amount
+        return True
+
+
+class RateLimit:
+    # Messages and bytes per second for one client or a whole channel
+
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self, messages_per_second, bytes_per_second):
+        self.messages = TokenBucket(messages_per_second) if messages_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    def limited(self):
+        return self.messages is not None or self.bytes is not None
+
+    def admit(self, size, now):
+        # Charges one message of size bytes, unless either bucket is short
+        if self.messages is not None and not self.messages.ready(1, now):
+            return False
+        if self.bytes is not None and not self.bytes.ready(size, now):
+            return False
+        if self.messages is not None:
+            self.messages.tokens -= 1
+        if self.bytes is not None:
+            self.bytes.tokens -= size
+        return True
+
+
+def parse_limits(fields):
+    # Four rates as given in the config file or to /limit
+    if len(fields) != 4:
+        raise ValueError
+    limits = tuple(float(field) for field in fields)
+    if not all(0 <= limit < float('inf') for limit in limits):
+        raise ValueError
+    return limits
+
+
+def describe_limits(limits):
+    user_messages, user_bytes, channel_messages, channel_bytes = limits
+    return (f"per user {describe_rate(user_messages, 'messages')} and {describe_rate(user_bytes, 'bytes')}, "
+            f"per channel {describe_rate(channel_messages, 'messages')} and {describe_rate(channel_bytes, 'bytes')}")
+
+
+def describe_rate(rate, unit):
+    return f"{rate:g} {unit}/s" if rate else f"unlimited {unit}"
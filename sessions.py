@@ -0,0 +1,86 @@
+import time
+
+
+class Session:
+    # One connected client. Slots keep the footprint of thousands of mostly idle
+    # clients small, and attribute access cheap on the message path.
+
+    __slots__ = (
+        'socket', 'addr', 'username', 'channel',
+        'state',        # handshake -> queued -> active -> closed
+        'position',     # last queue position the client was told
+        'history_seq',  # oldest channel history message the client has been sent
+        'last_active',
+        'afk_timer',    # pending AFK check on the server's TimerWheel
+        'codec',        # framed or raw, settled by the first bytes received
+        'greeting',     # bytes received before the codec is known
+        'outbox',       # OutboundQueue of bytes not yet written
+        'admitted',     # threaded mode: Event set when the client leaves the queue
+        'pending',      # eventloop mode: messages received while queued
+        'pending_dropped',  # eventloop mode: messages past QUEUED_MESSAGE_LIMIT dropped while queued
+        'ref',          # sharded and federated mode: names the session in broker messages
+        'limits',       # the channel limits rate_limit was made from
+        'rate_limit',   # RateLimit on what the client sends
+        'strikes',      # TokenBucket of rejections before the client is muted
+    )
+
+    def __init__(self, client_socket, addr, channel_name, outbox):
+        self.socket = client_socket
+        self.addr = addr
+        self.username = None
+        self.channel = channel_name
+        self.state = 'handshake'
+        self.position = None
+        self.history_seq = None
+        self.last_active = time.monotonic()
+        self.afk_timer = None
+        self.codec = None
+        self.greeting = b''
+        self.outbox = outbox
+        self.admitted = None
+        self.pending = None
+        self.pending_dropped = 0
+        self.ref = None
+        self.limits = None
+        self.rate_limit = None
+        self.strikes = None
+
+    def __repr__(self):
+        return f"<Session {self.username!r} {self.channel}/{self.state} {self.addr}>"
+
+
+class RemoteUser:
+    # Sharded mode: stands in for a member whose session lives in another worker
+    # process, or on another node of a federation. Anything sent to it is routed
+    # through the broker, or the channel's home node.
+
+    __slots__ = ('channel', 'username', 'state')
+
+    def __init__(self, channel_name, username):
+        self.channel = channel_name
+        self.username = username
+        self.state = 'active'
+
+    def __repr__(self):
+        return f"<RemoteUser {self.username!r} {self.channel}>"
+
+
+class SessionRegistry:
+    # Every connected session, for the server-wide walks: shutdown, /upgrade and the
+    # structure sizes. Lookups by username go through each channel's 'clients' and
+    # 'queue' dicts instead.
+
+    def __init__(self):
+        self.sessions = set()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+    def add(self, session):
+        self.sessions.add(session)
+
+    def remove(self, session):
+        self.sessions.discard(session)
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import resource
+import selectors
+
+from benchmark import Harness, parse_mix, process_tree
+from protocol import hello
+
+
+# Structures that must be empty again once every client has left and the last timer fired
+EMPTY_WHEN_IDLE = ('sessions', 'members', 'queued', 'muted', 'timers')
+
+# Churn actions and how often each is picked
+DEFAULT_MIX = 'chat=0.5,switch=0.1,quit=0.1,drop=0.1,kick=0.08,mute=0.08,empty=0.04'
+ACTIONS = ('chat', 'switch', 'quit', 'drop', 'kick', 'mute', 'empty')
+
+
+class SoakClient:
+    # One synthetic client. Sleepers never say anything after joining and are left for the
+    # server to disconnect as AFK.
+
+    __slots__ = ('name', 'channel', 'socket', 'outgoing', 'sleeper')
+
+    def __init__(self, name, channel, sleeper):
+        self.name = name
+        self.channel = channel
+        self.socket = None
+        self.outgoing = bytearray()
+        self.sleeper = sleeper
+
+
+def server_resources(pid):
+    # (resident set in KiB, threads, open file descriptors) summed over the server's processes
+    rss, threads, fds = 0, 0, 0
+    for proc in process_tree(pid):
+        try:
+            with open(f'/proc/{proc}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+            fds += len(os.listdir(f'/proc/{proc}/fd'))
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss, threads, fds
+
+
+def scrape_sizes(path):
+    # Structure sizes from the server's metrics socket, empty if it does not report them
+    sizes = {}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(path)
+            text = b''
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                text += data
+    except OSError:
+        return sizes
+    for line in text.decode('utf-8', 'replace').splitlines():
+        if line.startswith('chat_structure_size{'):
+            labels, _, value = line.rpartition(' ')
+            sizes[labels.split('"')[1]] = int(value)
+    return sizes
+
+
+class Soak(Harness):
+
+    def __init__(self, args):
+        super().__init__(args, [f'soak{i}' for i in range(args.channels)])
+        self.metrics_path = None
+        self.clients = []
+        self.names = 0
+        self.connections = 0    # made since the baseline
+        self.counts = dict.fromkeys(('connect',) + ACTIONS, 0)
+
+    def start_server(self):
+        self.write_config('soak-', self.args.capacity or max(1, self.args.clients * 3 // (4 * len(self.channels))))
+        self.metrics_path = self.config.name + '.metrics'
+        self.launch(['--metrics-socket', self.metrics_path, '--afk-timeout', str(self.args.afk_timeout)])
+
+    def stop_server(self):
+        super().stop_server()
+        if os.path.exists(self.metrics_path):
+            os.unlink(self.metrics_path)
+
+    # Client I/O
+
+    def connect(self):
+        self.names += 1
+        client = SoakClient(f's{self.names}', random.choice(self.channels), random.random() < self.args.sleepers)
+        client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.socket.setblocking(False)
+        client.socket.connect_ex(("127.0.0.1", self.ports[client.channel]))
+        client.outgoing += hello(client.name)
+        self.selector.register(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        self.clients.append(client)
+        self.connections += 1
+        self.counts['connect'] += 1
+
+    def close(self, client):
+        if client.socket is None:
+            return
+        self.clients.remove(client)
+        self.selector.unregister(client.socket)
+        client.socket.close()
+        client.socket = None
+
+    def read(self, client):
+        # What the server says is not checked, only that it is still talking
+        try:
+            data = client.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # Kicked, emptied out, turned away or disconnected as AFK
+            self.close(client)
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            if events & selectors.EVENT_WRITE and client.socket is not None:
+                self.flush(client)
+            if events & selectors.EVENT_READ and client.socket is not None:
+                self.read(client)
+
+    # Churn
+
+    def act(self):
+        pick = random.random()
+        kind = next(kind for acc, kind in self.mix if pick <= acc)
+        awake = [client for client in self.clients if not client.sleeper]
+        if kind == 'empty':
+            self.admin(f"/empty {random.choice(self.channels)}")
+        elif not awake:
+            return
+        else:
+            client = random.choice(awake)
+            if kind == 'chat':
+                self.send(client, f"soak {self.counts['chat']}")
+            elif kind == 'switch':
+                others = [channel for channel in self.channels if channel != client.channel]
+                if not others:
+                    return
+                client.channel = random.choice(others)
+                self.send(client, f"/switch {client.channel}")
+            elif kind == 'quit':
+                self.send(client, '/quit')
+            elif kind == 'drop':
+                self.close(client)
+            elif kind == 'kick':
+                self.admin(f"/kick {client.channel}:{client.name}")
+            elif kind == 'mute':
+                self.admin(f"/mute {client.channel}:{client.name} {self.args.mute_time}")
+        self.counts[kind] += 1
+
+    def churn(self, seconds):
+        args = self.args
+        started = time.monotonic()
+        issued = connected = 0
+        while time.monotonic() - started < seconds:
+            elapsed = time.monotonic() - started
+            due = int(elapsed * args.connect_rate)
+            while connected < due:
+                connected += 1
+                if len(self.clients) < args.clients:
+                    self.connect()
+            due = int(elapsed * args.rate)
+            while issued < due:
+                self.act()
+                issued += 1
+            self.poll(0.005)
+            if self.server.poll() is not None:
+                return
+
+    # Measurements
+
+    def sample(self):
+        rss, threads, fds = server_resources(self.server.pid)
+        return {'time': round(time.monotonic() - self.started, 1), 'clients': len(self.clients),
+                'rss_kib': rss, 'threads': threads, 'fds': fds, 'sizes': scrape_sizes(self.metrics_path)}
+
+    def settle(self, target):
+        # Every client leaves, then waits until the server is back to target or --settle
+        # seconds have passed, whichever comes first
+        for client in list(self.clients):
+            if random.random() < 0.5:
+                self.send(client, '/quit')
+            self.close(client)
+        deadline = time.monotonic() + self.args.settle
+        while True:
+            sample = self.sample()
+            if time.monotonic() > deadline or self.server.poll() is not None:
+                return sample
+            if target is None:
+                if all(not sample['sizes'].get(name) for name in EMPTY_WHEN_IDLE):
+                    # Give the threads of the last clients a moment to finish
+                    time.sleep(1)
+                    return self.sample()
+            elif (sample['threads'] <= target['threads'] and sample['fds'] <= target['fds'] and
+                    all(size <= target['sizes'].get(name, size) for name, size in sample['sizes'].items())):
+                return sample
+            time.sleep(0.5)
+
+    def check(self, checkpoint, baseline):
+        # Returns a line for every bound the checkpoint breaks
+        args = self.args
+        failures = []
+        if self.server.poll() is not None:
+            return [f"the server exited with status {self.server.returncode}"]
+        for name, bound in (('rss_kib', args.max_rss_growth), ('threads', args.max_thread_growth), ('fds', args.max_fd_growth)):
+            growth = checkpoint[name] - baseline[name]
+            if growth > bound:
+                failures.append(f"{name}: {baseline[name]} -> {checkpoint[name]} (bound +{bound})")
+        for name, size in checkpoint['sizes'].items():
+            growth = size - baseline['sizes'].get(name, 0)
+            if growth > args.max_size_growth:
+                failures.append(f"{name}: {baseline['sizes'].get(name, 0)} -> {size} (bound +{args.max_size_growth})")
+        if args.max_connection_bytes and checkpoint['bytes_per_connection'] > args.max_connection_bytes:
+            failures.append(f"bytes_per_connection: {checkpoint['bytes_per_connection']} (bound {args.max_connection_bytes})")
+        return failures
+
+    def run(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        self.start_server()
+        try:
+            return self.soak()
+        finally:
+            self.stop_server()
+
+    def soak(self):
+        args = self.args
+        self.started = time.monotonic()
+        # Warm up first, so caches, thread stacks and the allocator's arenas are in the baseline
+        self.churn(args.warmup)
+        baseline = self.settle(None)
+        self.connections = 0
+        samples, checkpoints, failures = [], [], []
+        next_checkpoint = time.monotonic() + args.checkpoint
+        ends = time.monotonic() + args.duration
+        while not failures and time.monotonic() < ends:
+            self.churn(min(args.interval, ends - time.monotonic(), next_checkpoint - time.monotonic()))
+            if time.monotonic() < min(next_checkpoint, ends):
+                samples.append(self.sample())
+                continue
+            # Nobody connected: whatever the server still holds beyond the baseline leaked
+            checkpoint = self.settle(baseline)
+            checkpoint['connections'] = self.connections
+            checkpoint['bytes_per_connection'] = round((checkpoint['rss_kib'] - baseline['rss_kib']) * 1024 / max(self.connections, 1))
+            checkpoints.append(checkpoint)
+            failures = self.check(checkpoint, baseline)
+            next_checkpoint = time.monotonic() + args.checkpoint
+
+        return {
+            'config': {
+                'clients': args.clients, 'channels': args.channels, 'mode': args.mode, 'workers': args.workers,
+                'duration': args.duration, 'rate': args.rate, 'mix': args.mix, 'sleepers': args.sleepers,
+                'afk_timeout': args.afk_timeout, 'server_args': args.server_args, 'python': sys.version.split()[0],
+            },
+            'actions': self.counts,
+            'baseline': baseline,
+            'checkpoints': checkpoints,
+            'samples': samples,
+            'failures': failures,
+        }
+
+
+def parse_churn(text):
+    return parse_mix(text, ACTIONS, 'churn action')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Churn clients against chatserver.py for a long time and fail if its memory, threads, file descriptors or internal structures keep growing.")
+    parser.add_argument('--duration', type=float, default=3600, help="seconds of churn after the warmup")
+    parser.add_argument('--warmup', type=float, default=30)
+    parser.add_argument('--checkpoint', type=float, default=300, help="seconds between leak checks, each one disconnects everyone")
+    parser.add_argument('--settle', type=float, help="seconds a check waits for the server to let go, default --afk-timeout + 5")
+    parser.add_argument('--interval', type=float, default=10, help="seconds between samples under load")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--capacity', type=int, default=0, help="per channel, default three quarters of the clients fit")
+    parser.add_argument('--mode', choices=['threaded', 'eventloop'], default='threaded')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=100, help="churn actions per second")
+    parser.add_argument('--connect-rate', type=float, default=50, help="new connections per second, up to --clients")
+    parser.add_argument('--mix', type=parse_churn, default=parse_churn(DEFAULT_MIX))
+    parser.add_argument('--sleepers', type=float, default=0.1, help="share of clients that go AFK")
+    parser.add_argument('--afk-timeout', type=float, default=10)
+    parser.add_argument('--mute-time', type=int, default=2)
+    parser.add_argument('--max-rss-growth', type=int, default=16384, help="KiB")
+    parser.add_argument('--max-thread-growth', type=int, default=0)
+    parser.add_argument('--max-fd-growth', type=int, default=0)
+    parser.add_argument('--max-size-growth', type=int, default=0, help="entries, for every structure the server reports")
+    parser.add_argument('--max-connection-bytes', type=int, default=0, help="RSS growth per connection made, 0 does not check")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--server-log')
+    parser.add_argument('server_args', nargs='*', help="extra chatserver.py options, after --")
+    args = parser.parse_args()
+    if args.settle is None:
+        args.settle = args.afk_timeout + 5
+
+    report = Soak(args).run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    for line in report['failures']:
+        print(f"Leak: {line}", file=sys.stderr)
+    if report['failures']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import unittest
+import subprocess
+
+from benchmark import SERVER, free_ports
+from protocol import FrameDecoder, encode_frame, hello
+
+
+class FloodMuteTest(unittest.TestCase):
+    # Runs a server with a tight per-user limit and floods it from one member
+
+    def setUp(self):
+        self.port, = free_ports(1)
+        self.config = tempfile.NamedTemporaryFile('w', prefix='flood-', suffix='.cfg', delete=False)
+        self.config.write(f"channel flood {self.port} 5\nlimit * 2 0 0 0\n")
+        self.config.close()
+        command = [sys.executable, SERVER, self.config.name, '--mode', 'eventloop',
+                   '--flood-strikes', '3', '--flood-mute', '30']
+        self.server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                if self.server.poll() is not None or time.monotonic() > deadline:
+                    self.fail("The server did not start.")
+                time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.kill()
+        self.server.wait()
+        os.unlink(self.config.name)
+
+    def connect(self, username):
+        client = socket.create_connection(("127.0.0.1", self.port))
+        client.sendall(hello(username))
+        return client
+
+    def receive(self, client, seconds):
+        # Every message received within the next few seconds
+        decoder = FrameDecoder()
+        messages = []
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            client.settimeout(max(0.01, deadline - time.monotonic()))
+            try:
+                data = client.recv(65536)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            messages += [payload.decode('utf-8') for kind, payload in decoder.feed(data)]
+        return messages
+
+    def test_one_flood_mutes_once(self):
+        watcher = self.connect('watcher')
+        flooder = self.connect('flooder')
+        self.receive(watcher, 0.3)
+        self.receive(flooder, 0.3)
+
+        flooder.sendall(b''.join(encode_frame(f'spam {i}'.encode('utf-8')) for i in range(20)))
+        seen = self.receive(watcher, 1.5)
+        replies = self.receive(flooder, 0.5)
+
+        self.assertEqual(sum('flooder has been muted' in msg for msg in seen), 1)
+        self.assertEqual(sum('You have been muted' in msg for msg in replies), 1)
+        self.assertTrue(any('You are still muted' in msg for msg in replies))
+        watcher.close()
+        flooder.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import time
+import threading
+
+
+class Timer:
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline    # wheel tick it fires on
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    # Hashed timing wheel on the monotonic clock that owns every deadline in the server:
+    # AFK checks, mute expiries and queue position updates. schedule() and cancel() are
+    # O(1) and everything due in the same tick fires together from expire().
+
+    def __init__(self, resolution=0.1, slots=512):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.tick = self.now_tick()     # last tick expire() has handled
+        self.pending = 0                # timers in the slots, cancelled ones included
+        self.lock = threading.Lock()
+
+    def now_tick(self):
+        return int(time.monotonic() / self.resolution)
+
+    def schedule(self, delay, callback, *args):
+        # Fires no earlier than delay seconds from now, and at most one tick later
+        deadline = int((time.monotonic() + delay) / self.resolution) + 1
+        timer = Timer(deadline, callback, args)
+        with self.lock:
+            self.slots[deadline % len(self.slots)].append(timer)
+            self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        # Left in its slot and dropped when the slot comes round
+        if timer is not None:
+            timer.cancelled = True
+
+    def expire(self):
+        # Runs every timer now due, without holding the lock, so callbacks may schedule more
+        now = self.now_tick()
+        due = []
+        with self.lock:
+            slot_count = len(self.slots)
+            # After a stall longer than one turn of the wheel every slot is visited once
+            for tick in range(max(self.tick + 1, now - slot_count + 1), now + 1):
+                slot = self.slots[tick % slot_count]
+                if not slot:
+                    continue
+                later = [timer for timer in slot if timer.deadline > now]
+                if len(later) != len(slot):
+                    due.extend(timer for timer in slot if timer.deadline <= now)
+                    self.slots[tick % slot_count] = later
+            self.tick = now
+            self.pending -= len(due)
+
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"Error in timer: {e}")
+
+    def timeout(self):
+        # Seconds until the next tick, or None while nothing is scheduled
+        if not self.pending:
+            return None
+        return max(0.0, (self.tick + 1) * self.resolution - time.monotonic())
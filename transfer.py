@@ -0,0 +1,118 @@
+import os
+import socket
+import time
+
+from protocol import FILE_CHUNK, FILE_END, FILE_HEADER, FILE_START, FILE_START_HEADER, HEADER, encode_frame
+
+
+# Bytes of file data per FILE_CHUNK frame. Chat queued behind a transfer waits for
+# at most one chunk, however big the file is.
+CHUNK_SIZE = 64 * 1024
+
+# Largest file /send accepts
+DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024
+
+# Seconds between progress reports to the sender
+PROGRESS_INTERVAL = 1.0
+
+
+class FileFrame:
+    # One FILE_CHUNK frame. Only the header is held in memory, the data goes from the
+    # page cache to the socket with sendfile() once the header is out.
+
+    __slots__ = ('transfer', 'header', 'offset', 'end')
+
+    def __init__(self, transfer, offset, count):
+        self.transfer = transfer
+        self.header = HEADER.pack(FILE_HEADER.size + count, FILE_CHUNK) + FILE_HEADER.pack(transfer.id)
+        self.offset = offset
+        self.end = offset + count
+
+    def write(self, sock):
+        # Same contract as OutboundQueue.write(): True once the frame is fully written,
+        # False when the socket is full, other socket errors are raised
+        try:
+            while self.header:
+                sent = sock.send(self.header, socket.MSG_DONTWAIT)
+                self.header = self.header[sent:]
+            while self.offset < self.end:
+                count = self.end - self.offset
+                if sock.gettimeout() == 0.0 and hasattr(os, 'sendfile'):
+                    sent = os.sendfile(sock.fileno(), self.transfer.file.fileno(), self.offset, count)
+                else:
+                    # A blocking socket would make sendfile() wait for room, so threaded mode
+                    # reads a bounded slice and sends it with MSG_DONTWAIT instead
+                    data = os.pread(self.transfer.file.fileno(), min(count, CHUNK_SIZE), self.offset)
+                    sent = sock.send(data, socket.MSG_DONTWAIT)
+                if not sent:
+                    raise ConnectionResetError("file shrank or peer closed during transfer")
+                self.offset += sent
+                self.transfer.sent += sent
+        except (BlockingIOError, InterruptedError):
+            return False
+        return True
+
+
+class Transfer:
+    # A file on its way to one client. The target's OutboundQueue pulls frames from it
+    # one at a time, only when nothing else is waiting to be written.
+
+    __slots__ = ('id', 'file', 'name', 'size', 'sender', 'target', 'notify',
+                 'offset', 'sent', 'started', 'last_report', 'state')
+
+    def __init__(self, transfer_id, file, name, size, sender, target, notify):
+        self.id = transfer_id
+        self.file = file
+        self.name = name
+        self.size = size
+        self.sender = sender
+        self.target = target
+        self.notify = notify    # called with (transfer, event) for 'progress', 'done' and 'aborted'
+        self.offset = 0         # next file offset to frame
+        self.sent = 0           # file bytes written to the socket
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.state = 'new'      # new -> sending -> done or aborted
+
+    def next_frame(self):
+        # The next frame to write, or None once the FILE_END frame has been handed out
+        if self.state == 'new':
+            self.state = 'sending'
+            return encode_frame(FILE_START_HEADER.pack(self.id, self.size) + self.name.encode('utf-8'), FILE_START)
+        if self.state != 'sending':
+            return None
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.notify(self, 'progress')
+        if self.offset < self.size:
+            count = min(CHUNK_SIZE, self.size - self.offset)
+            frame = FileFrame(self, self.offset, count)
+            self.offset += count
+            return frame
+        self.state = 'done'
+        self.file.close()
+        self.notify(self, 'done')
+        return encode_frame(FILE_HEADER.pack(self.id), FILE_END)
+
+    def abort(self):
+        if self.state in ('done', 'aborted'):
+            return
+        self.state = 'aborted'
+        self.file.close()
+        self.notify(self, 'aborted')
+
+    def elapsed(self):
+        return max(time.monotonic() - self.started, 1e-6)
+
+    def throughput(self):
+        # Bytes per second so far
+        return self.sent / self.elapsed()
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"